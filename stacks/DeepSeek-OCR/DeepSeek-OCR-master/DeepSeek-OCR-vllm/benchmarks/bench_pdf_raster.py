@@ -0,0 +1,75 @@
+"""Rasterization throughput: sequential vs. multi-process, on a synthetic PDF.
+
+    python benchmarks/bench_pdf_raster.py --pages 400 --dpi 144
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import fitz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.pdf_render import ParallelPdfRasterizer, iter_pdf_images
+
+
+def make_synthetic_pdf(path, num_pages, seed=0):
+    """Text-dense A4 pages with a few vector boxes, similar to statements."""
+    rng = random.Random(seed)
+    words = ["balance", "invoice", "total", "amount", "date", "account", "payment",
+             "reference", "description", "credit", "debit", "0.00", "1,234.56"]
+    doc = fitz.open()
+    for _ in range(num_pages):
+        page = doc.new_page(width=595, height=842)
+        y = 60
+        while y < 780:
+            line = " ".join(rng.choice(words) for _ in range(12))
+            page.insert_text((50, y), line, fontsize=9)
+            y += 13
+        for _ in range(6):
+            x0, y0 = rng.uniform(40, 400), rng.uniform(40, 700)
+            page.draw_rect(fitz.Rect(x0, y0, x0 + 150, y0 + 60), color=(0, 0, 0), width=0.5)
+    doc.save(path)
+    doc.close()
+
+
+def timed(pages_iter):
+    start = time.perf_counter()
+    count = 0
+    for image in pages_iter:
+        image.getpixel((0, 0))
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--dpi", type=int, default=144)
+    parser.add_argument("--prefetch", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="*", default=None)
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, 8, cpus} & set(range(1, cpus + 1)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        make_synthetic_pdf(pdf_path, args.pages)
+
+        count, seconds = timed(iter_pdf_images(pdf_path, dpi=args.dpi))
+        baseline = count / seconds
+        print(f"{'sequential':>18}: {baseline:7.1f} pages/s")
+
+        for workers in worker_counts:
+            rasterizer = ParallelPdfRasterizer(pdf_path, dpi=args.dpi, workers=workers, prefetch=args.prefetch)
+            count, seconds = timed(rasterizer)
+            rate = count / seconds
+            print(f"{f'{workers} worker(s)':>18}: {rate:7.1f} pages/s  x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Per-page cost of turning a PyMuPDF pixmap into a PIL image / array.
+
+Compares the old PNG round trip (`tobytes("png")` + `Image.open`) with
+wrapping the raw samples (`Image.frombuffer`, `np.frombuffer`).
+
+    python benchmarks/bench_pixmap_decode.py --pages 50 --dpi 144
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import fitz
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_pdf_raster import make_synthetic_pdf
+from process.pdf_render import pixmap_to_array, pixmap_to_image
+
+
+def png_round_trip(pixmap):
+    img = Image.open(io.BytesIO(pixmap.tobytes("png")))
+    img.load()
+    return img
+
+
+def from_buffer(pixmap):
+    img = pixmap_to_image(pixmap)
+    img.load()
+    return img
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--dpi", type=int, default=144)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "synthetic.pdf")
+        make_synthetic_pdf(pdf_path, args.pages)
+
+        zoom = args.dpi / 72.0
+        matrix = fitz.Matrix(zoom, zoom)
+        timings = {"render": 0.0, "png round trip": 0.0, "Image.frombuffer": 0.0, "np.frombuffer": 0.0}
+
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                start = time.perf_counter()
+                pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+                timings["render"] += time.perf_counter() - start
+
+                for name, convert in (("png round trip", png_round_trip),
+                                      ("Image.frombuffer", from_buffer),
+                                      ("np.frombuffer", pixmap_to_array)):
+                    start = time.perf_counter()
+                    convert(pixmap)
+                    timings[name] += time.perf_counter() - start
+
+        print(f"{args.pages} pages at {args.dpi} dpi ({pixmap.width}x{pixmap.height})")
+        for name, total in timings.items():
+            print(f"{name:>18}: {total / args.pages * 1000:8.2f} ms/page")
+
+
+if __name__ == "__main__":
+    main()
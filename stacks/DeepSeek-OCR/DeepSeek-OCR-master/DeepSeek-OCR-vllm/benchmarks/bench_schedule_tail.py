@@ -0,0 +1,135 @@
+"""Batch tail latency: arrival order vs. longest-predicted-first, on a mixed corpus.
+
+Renders a synthetic corpus of sparse letters, text pages and dense tables,
+predicts every page's output length with the runner's estimator (ink ratio x
+vision views) and replays the batch through a continuous-batching model of
+the engine: `--slots` concurrent sequences, one token per running sequence
+per step, step time `--step-ms` + `--seq-us` per running sequence. The true
+decode length of a page is derived from the characters drawn on it.
+
+Reports the makespan, the tail (time between 90% and 100% of pages done)
+and the mean number of busy slots during the tail.
+
+    python benchmarks/bench_schedule_tail.py --pages 300 --slots 64
+"""
+import argparse
+import heapq
+import os
+import random
+import sys
+import tempfile
+
+import fitz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.image_process import count_views
+from process.page_stats import estimate_output_tokens, ink_ratio
+from process.pdf_render import iter_pdf_images
+
+CHARS_PER_TOKEN = 3.2
+WORDS = ["balance", "invoice", "total", "amount", "date", "account", "payment", "reference",
+         "description", "credit", "debit", "0.00", "1,234.56", "31/12/2024", "GBP"]
+
+
+def make_mixed_pdf(path, num_pages, seed=0):
+    """Pages of three kinds; returns the number of characters drawn on each page."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    chars = []
+    for _ in range(num_pages):
+        page = doc.new_page(width=595, height=842)
+        kind = rng.choices(["letter", "text", "table"], weights=[3, 6, 1])[0]
+        drawn = 0
+        if kind == "table":
+            # small type in ruled cells: the long-decoding pages of a statement run
+            y = 40
+            while y < 810:
+                for col in range(8):
+                    cell = rng.choice(WORDS)
+                    page.insert_text((30 + col * 68, y), cell, fontsize=6)
+                    drawn += len(cell) + 9  # <td></td>
+                page.draw_line((28, y + 2), (567, y + 2), width=0.3)
+                y += 8
+        else:
+            lines = rng.randint(4, 14) if kind == "letter" else rng.randint(35, 58)
+            y = 60
+            for _ in range(lines):
+                line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 12)))
+                page.insert_text((50, y), line, fontsize=9)
+                drawn += len(line)
+                y += 13
+        chars.append(drawn)
+    doc.save(path)
+    doc.close()
+    return chars
+
+
+def simulate(lengths, order, slots, step_ms, seq_us):
+    """Finish time (s) of every request when submitted in `order` to a `slots`-wide engine."""
+    finish = [0.0] * len(lengths)
+    waiting = list(reversed(order))
+    running = []  # (token step at which it finishes, request)
+    now, step = 0.0, 0
+    busy = []     # (start, end, running) per step, for tail occupancy
+    while waiting or running:
+        while waiting and len(running) < slots:
+            request = waiting.pop()
+            heapq.heappush(running, (step + lengths[request], request))
+        # advance to the next completion in one go
+        next_step = running[0][0]
+        step_time = (step_ms / 1000 + seq_us / 1e6 * len(running)) * (next_step - step)
+        busy.append((now, now + step_time, len(running)))
+        now += step_time
+        step = next_step
+        while running and running[0][0] == step:
+            finish[heapq.heappop(running)[1]] = now
+    return finish, busy
+
+
+def tail_stats(finish, busy, fraction=0.9):
+    done = sorted(finish)
+    tail_start = done[int(len(done) * fraction) - 1]
+    makespan = done[-1]
+    occupied = sum((min(end, makespan) - max(start, tail_start)) * n
+                   for start, end, n in busy if end > tail_start)
+    return makespan, makespan - tail_start, occupied / max(makespan - tail_start, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--slots", type=int, default=64)
+    parser.add_argument("--step-ms", type=float, default=22.0)
+    parser.add_argument("--seq-us", type=float, default=120.0)
+    parser.add_argument("--dpi", type=int, default=144)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "mixed.pdf")
+        chars = make_mixed_pdf(pdf_path, args.pages, args.seed)
+        predicted = [estimate_output_tokens(ink_ratio(image), count_views(*image.size))
+                     for image in iter_pdf_images(pdf_path, dpi=args.dpi)]
+
+    # true length: characters drawn plus grounding tags, with some noise, capped like max_tokens
+    lengths = [min(8192, max(16, int(c / CHARS_PER_TOKEN * rng.uniform(0.85, 1.15)) + 40)) for c in chars]
+
+    arrival = list(range(args.pages))
+    schedules = {
+        "arrival order": arrival,
+        "longest predicted": sorted(arrival, key=lambda i: -predicted[i]),
+        "longest (oracle)": sorted(arrival, key=lambda i: -lengths[i]),
+    }
+
+    print(f"{args.pages} pages, {sum(lengths)} tokens, {args.slots} slots, "
+          f"longest page {max(lengths)} tokens")
+    for name, order in schedules.items():
+        makespan, tail, occupancy = tail_stats(*simulate(lengths, order, args.slots, args.step_ms, args.seq_us))
+        print(f"{name:>18}: makespan {makespan:7.1f}s  tail (last 10%) {tail:6.1f}s  "
+              f"busy slots in tail {occupancy:5.1f}/{args.slots}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Request handling cost of a scan upload: base64 JSON body vs. raw binary body.
+
+Replays what the server does with each body, without the model: the body
+arrives in 64 KiB ASGI chunks, then
+
+  json:   joined into one bytes object, parsed, validated (pydantic when
+          installed), base64-decoded and opened from a BytesIO copy;
+  binary: streamed into a pooled `UploadBuffer` and opened in place.
+
+`--concurrency` requests are in flight at once, as on a busy server. Each
+path runs in a fresh process and reports requests/s and the tracemalloc
+peak (Python-level copies of the payload; PIL's pixel memory is not
+traced) after a warm-up round, and the growth of peak RSS including it.
+`--no-decode` stops before the image decode to isolate body handling.
+
+    python benchmarks/bench_upload_paths.py --mb 5 --requests 64 --concurrency 8
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.upload import BufferPool, decode_image_buffer, read_body
+
+try:
+    from pydantic import BaseModel
+
+    class OCRRequest(BaseModel):
+        prompt: str
+        image_base64: str
+except ImportError:
+    OCRRequest = None
+
+CHUNK = 64 * 1024
+PROMPT = "<image>\n<|grounding|>Convert the document to markdown."
+
+
+def make_scan(target_mb, seed=0):
+    """A grey, noisy A4 page at 300 dpi, JPEG-compressed to roughly `target_mb`."""
+    rng = np.random.default_rng(seed)
+    page = np.full((3508, 2480), 235, np.int16)
+    for _ in range(1200):
+        y, x = rng.integers(100, 3400), rng.integers(100, 2300)
+        page[y:y + rng.integers(8, 30), x:x + rng.integers(20, 160)] = rng.integers(10, 80)
+    page = np.clip(page + rng.normal(0, 14, page.shape), 0, 255).astype(np.uint8)
+    image = Image.fromarray(page).convert("RGB")
+
+    data = b""
+    for quality in (70, 80, 88, 93, 96, 98):
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        data = buffer.getvalue()
+        if len(data) >= target_mb * 1024 * 1024:
+            break
+    return data
+
+
+async def body_chunks(body):
+    view = memoryview(body)
+    for start in range(0, len(body), CHUNK):
+        yield bytes(view[start:start + CHUNK])
+        await asyncio.sleep(0)
+
+
+async def handle_json(body, decode):
+    raw = b"".join([chunk async for chunk in body_chunks(body)])
+    payload = json.loads(raw)
+    if OCRRequest is not None:
+        payload = OCRRequest(**payload).__dict__
+    image_bytes = base64.b64decode(payload["image_base64"])
+    if decode:
+        image = Image.open(io.BytesIO(image_bytes))
+        ImageOps.exif_transpose(image).convert("RGB")
+    return len(image_bytes)
+
+
+async def handle_binary(body, decode, pool):
+    with pool.borrow() as buffer:
+        await read_body(body_chunks(body), buffer, 1 << 30)
+        if decode:
+            decode_image_buffer(buffer.view())
+        return buffer.length
+
+
+def run_path(path, scan, requests, concurrency, decode, queue):
+    if path == "json":
+        body = json.dumps({"prompt": PROMPT, "image_base64": base64.b64encode(scan).decode()}).encode()
+    else:
+        body = scan
+    pool = BufferPool(max_idle=concurrency)
+
+    async def worker(count):
+        for _ in range(count):
+            if path == "json":
+                await handle_json(body, decode)
+            else:
+                await handle_binary(body, decode, pool)
+
+    async def run_all(requests):
+        per_worker = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+        await asyncio.gather(*(worker(count) for count in per_worker))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # one request per worker first, so the pool holds warm buffers as on a running server
+    asyncio.run(run_all(concurrency))
+    tracemalloc.start()
+    start = time.perf_counter()
+    asyncio.run(run_all(requests))
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    queue.put({"body_mb": len(body) / 2**20, "requests_per_second": requests / seconds,
+               "traced_peak_mb": peak / 2**20, "rss_growth_mb": rss_growth / 1024})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mb", type=float, default=5.0, help="size of the JPEG scan")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-decode", action="store_true")
+    args = parser.parse_args()
+
+    scan = make_scan(args.mb)
+    print(f"scan {len(scan) / 2**20:.2f} MB, {args.requests} requests, concurrency {args.concurrency}, "
+          f"{'no decode' if args.no_decode else 'with decode'}, pydantic {'on' if OCRRequest else 'off'}")
+
+    # a fresh process per path keeps peak RSS comparable
+    context = multiprocessing.get_context("spawn")
+    for path in ("json", "binary"):
+        queue = context.Queue()
+        process = context.Process(target=run_path, args=(path, scan, args.requests, args.concurrency,
+                                                         not args.no_decode, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        print(f"{path:>7}: body {result['body_mb']:5.2f} MB  {result['requests_per_second']:7.1f} req/s  "
+              f"traced peak {result['traced_peak_mb']:7.1f} MB  peak RSS growth {result['rss_growth_mb']:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
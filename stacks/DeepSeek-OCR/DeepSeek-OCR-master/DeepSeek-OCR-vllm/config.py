@@ -32,5 +32,82 @@ INPUT_PATH = os.getenv("INPUT_PATH", "")
 OUTPUT_PATH = os.getenv("OUTPUT_PATH", "")
 PROMPT = os.getenv("PROMPT", "<image>\n<|grounding|>Convert the document to markdown.")
 
+# OCR result cache (FastAPI server); RESULT_CACHE_DIR enables the on-disk tier
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+
+# FastAPI uploads: raw image/* and multipart bodies are streamed into pooled, reusable buffers
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 64 * 1024 * 1024))
+UPLOAD_BUFFERS = int(os.getenv("UPLOAD_BUFFERS", 8))
+
+# FastAPI preprocessing (image decode + tiling) worker threads; requests beyond
+# PREPROCESS_MAX_PENDING waiting or in preprocessing are refused with 429
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", 4))
+PREPROCESS_MAX_PENDING = int(os.getenv("PREPROCESS_MAX_PENDING", 64))
+
+# FastAPI: abort generations still running this many seconds after the request arrived (0 = no deadline)
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 0))
+
+# FastAPI /ocr/batch: most images accepted in one request
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", 64))
+
+# FastAPI /ocr/pdf: pages rendered and submitted ahead of the one being streamed back
+PDF_INFLIGHT_PAGES = int(os.getenv("PDF_INFLIGHT_PAGES", 32))
+
+# FastAPI /jobs: durable job queue in JOB_DIR (SQLite + per-job results; unset = disabled); the worker
+# keeps pages in the engine up to JOB_INFLIGHT_TOKENS (prompt + predicted output tokens)
+JOB_DIR = os.getenv("JOB_DIR", "")
+JOB_INFLIGHT_TOKENS = int(os.getenv("JOB_INFLIGHT_TOKENS", 256 * 1024))
+
+# FastAPI /admin/profile: torch.profiler captures are written under PROFILE_DIR, each stops after at most
+# PROFILE_MAX_SECONDS; requests need "Authorization: Bearer <ADMIN_TOKEN>" (either unset = endpoint disabled)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 300))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Projected vision-embedding cache (per model instance); 0/0 disables it. The GPU tier is allocated
+# outside vLLM's memory profiling, so it is off by default: when enabling it, lower the engine's
+# gpu_memory_utilization by at least VISION_CACHE_GPU_MB worth of the card
+VISION_CACHE_GPU_MB = int(os.getenv("VISION_CACHE_GPU_MB", 0))
+VISION_CACHE_CPU_MB = int(os.getenv("VISION_CACHE_CPU_MB", 1024))
+MM_PREPROCESSOR_CACHE = os.getenv("MM_PREPROCESSOR_CACHE", "false").lower() == "true"
+
+# PDF runner: skip pages whose ink ratio (see process/page_stats.py) is below the threshold
+SKIP_BLANK_PAGES = os.getenv("SKIP_BLANK_PAGES", "false").lower() == "true"
+BLANK_PAGE_THRESHOLD = float(os.getenv("BLANK_PAGE_THRESHOLD", 0.0005))
+
+# PDF runner: rasterize lazily and feed an AsyncLLMEngine; at most STREAM_QUEUE_DEPTH pages in memory
+STREAM_MODE = os.getenv("STREAM_MODE", "false").lower() == "true"
+STREAM_QUEUE_DEPTH = int(os.getenv("STREAM_QUEUE_DEPTH", MAX_CONCURRENCY * 2))
+
+# PDF rasterization: >1 renders page ranges in forked worker processes
+RASTER_WORKERS = int(os.getenv("RASTER_WORKERS", 1))
+RASTER_PREFETCH = int(os.getenv("RASTER_PREFETCH", 16))
+# Render each page at the smallest DPI that covers the mode's tile grid, never below MIN_RENDER_DPI
+RENDER_DPI = int(os.getenv("RENDER_DPI", 144))
+MATCH_RENDER_DPI = os.getenv("MATCH_RENDER_DPI", "false").lower() == "true"
+MIN_RENDER_DPI = int(os.getenv("MIN_RENDER_DPI", 96))
+
+# PDF runner: serve born-digital pages from their embedded text layer instead of OCR
+USE_TEXT_LAYER = os.getenv("USE_TEXT_LAYER", "false").lower() == "true"
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", 200))
+TEXT_LAYER_MAX_IMAGE_COVERAGE = float(os.getenv("TEXT_LAYER_MAX_IMAGE_COVERAGE", 0.5))
+
+# PDF runner: journal finished pages to <name>_journal.jsonl and skip them when the job is rerun;
+# batch mode then generates JOURNAL_CHUNK_PAGES pages per llm.generate call so progress is persisted
+JOB_JOURNAL = os.getenv("JOB_JOURNAL", "false").lower() == "true"
+JOURNAL_CHUNK_PAGES = int(os.getenv("JOURNAL_CHUNK_PAGES", MAX_CONCURRENCY * 4))
+
+# PDF runner layout PDF: 'on' draws it during the run, 'deferred' leaves it to render_layouts.py
+# (from _layout.jsonl), 'off' skips it; figure crops are always saved. LAYOUT_WORKERS=0 renders inline
+LAYOUT_MODE = os.getenv("LAYOUT_MODE", "on").lower()
+LAYOUT_WORKERS = int(os.getenv("LAYOUT_WORKERS", 4))
+
+# Batch runners: predict each page's output length (ink ratio x vision views) and decode the longest first
+SCHEDULE_BY_LENGTH = os.getenv("SCHEDULE_BY_LENGTH", "false").lower() == "true"
+
+# Single-image daemon (run_dpsk_ocr_image.py --serve) and its client, ocr_client.py
+OCR_SOCKET = os.getenv("OCR_SOCKET", "/tmp/deepseek-ocr.sock")
+
 # Initialize tokenizer dynamically
 TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
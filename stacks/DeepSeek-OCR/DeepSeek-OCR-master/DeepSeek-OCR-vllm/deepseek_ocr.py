@@ -42,7 +42,11 @@ from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import (IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT,
+                    MODEL_MODE, MIN_CROPS, MAX_CROPS, VISION_CACHE_GPU_MB, VISION_CACHE_CPU_MB)
+from process.vision_cache import VisionEmbeddingCache
+from process.metrics import encoder_timer
+from process import profiling
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -185,6 +189,7 @@ class DeepseekOCRMultiModalProcessor(
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
             # image_embeds=MultiModalFieldConfig.batched("image2"),
             images_crop=MultiModalFieldConfig.batched("image"),
+            image_hashes=MultiModalFieldConfig.batched("image"),
         )
 
     def _get_prompt_updates(
@@ -292,6 +297,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         self.projector =  MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
+
+        # projected embeddings keyed by (image hash, mode), see process/vision_cache.py
+        if VISION_CACHE_GPU_MB > 0 or VISION_CACHE_CPU_MB > 0:
+            self.vision_cache = VisionEmbeddingCache(VISION_CACHE_GPU_MB * 1024 * 1024,
+                                                     VISION_CACHE_CPU_MB * 1024 * 1024)
+        else:
+            self.vision_cache = None
+        self.vision_cache_mode = f"{MODEL_MODE}:{MIN_CROPS}-{MAX_CROPS}"
     
         # self.sam_model = torch.compile(self.sam_model, mode="reduce-overhead")
         # self.vision_model = torch.compile(self.vision_model, mode="reduce-overhead")
@@ -336,6 +349,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        image_hashes = kwargs.pop("image_hashes", None)
 
 
         if pixel_values is None or torch.sum(pixel_values).item() == 0:
@@ -354,7 +368,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            return [pixel_values, images_crop, images_spatial_crop, image_hashes]
 
 
         raise AssertionError("This line should be unreachable.")
@@ -366,6 +380,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values: torch.Tensor,
         images_crop: torch.Tensor,
         images_spatial_crop: torch.Tensor,
+        image_hashes: Optional[torch.Tensor] = None,
     ) -> NestedTensors:
 
         # Pixel_values (global view): [n_image, batch_size, 3, height, width]
@@ -388,23 +403,39 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 image_ori = pixel_values[jdx]
                 crop_shape = images_spatial_crop[jdx][0]
 
+                cache_key = None
+                if self.vision_cache is not None and image_hashes is not None:
+                    digest = tuple(image_hashes[jdx][0].tolist())
+                    if any(digest):
+                        cache_key = (digest, self.vision_cache_mode)
+                        cached = self.vision_cache.get(cache_key, image_ori.device)
+                        if cached is not None:
+                            images_in_this_batch.append(cached)
+                            continue
+
                 if torch.sum(patches).item() != 0:  # if all values = 0, no crop
                     # P, C, H, W = patches.shape
                     # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
+                    with profiling.stage("sam", sync=True):
+                        local_features_1 = self.sam_model(patches)
                     #TODO del patches 
                     # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
+                    with profiling.stage("clip", sync=True):
+                        local_features_2 = self.vision_model(patches, local_features_1)
 
 
                     local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
+                    with profiling.stage("projector", sync=True):
+                        local_features = self.projector(local_features)
 
 
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
+                    with profiling.stage("sam", sync=True):
+                        global_features_1 = self.sam_model(image_ori)
+                    with profiling.stage("clip", sync=True):
+                        global_features_2 = self.vision_model(image_ori, global_features_1)
                     global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                    with profiling.stage("projector", sync=True):
+                        global_features = self.projector(global_features)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
@@ -438,10 +469,13 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
                 
                 else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
+                    with profiling.stage("sam", sync=True):
+                        global_features_1 = self.sam_model(image_ori)
+                    with profiling.stage("clip", sync=True):
+                        global_features_2 = self.vision_model(image_ori, global_features_1)
                     global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                    with profiling.stage("projector", sync=True):
+                        global_features = self.projector(global_features)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
@@ -462,6 +496,9 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
 
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
+                if cache_key is not None:
+                    self.vision_cache.put(cache_key, global_local_features)
+
                 images_in_this_batch.append(global_local_features)
 
         return images_in_this_batch
@@ -481,15 +518,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         images_crop = image_input[1]
         # images_crop = image_input[1]
         images_spatial_crop = image_input[2].to(dtype=torch.long)
+        image_hashes = image_input[3]
 
-        # local_start = time.time()
-        vision_features = self._pixel_values_to_embedding(
-            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop)
-
-        # local_total_time = time.time() - local_start
+        # GPU time of the forward, read back asynchronously as deepseek_ocr:encoder_forward_time_seconds
+        with encoder_timer.time():
+            vision_features = self._pixel_values_to_embedding(
+                pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop,
+                image_hashes=image_hashes)
 
-        # print('encoder_time: ', local_total_time)
-        # exit()
         return vision_features
 
     def get_language_model(self) -> torch.nn.Module:
@@ -545,10 +581,11 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                                                       vision_embeddings)
             input_ids = None
 
-        hidden_states = self.language_model(input_ids,
-                                            positions,
-                                            intermediate_tensors,
-                                            inputs_embeds=inputs_embeds)
+        with profiling.stage("llm", sync=True):
+            hidden_states = self.language_model(input_ids,
+                                                positions,
+                                                intermediate_tensors,
+                                                inputs_embeds=inputs_embeds)
 
         return hidden_states
 
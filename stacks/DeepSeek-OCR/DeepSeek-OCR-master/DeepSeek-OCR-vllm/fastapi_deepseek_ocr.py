@@ -1,13 +1,18 @@
 import os
-import io
 import base64
 import time
 import asyncio
+import contextlib
+import hmac
+import json
+import uuid
+import fitz
 import torch
-from PIL import Image, ImageOps
-from fastapi import FastAPI
+from typing import List, Literal
+from PIL import Image
+from fastapi import FastAPI, Request
 from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from vllm import AsyncLLMEngine, SamplingParams
 from vllm.engine.arg_utils import AsyncEngineArgs
@@ -16,8 +21,21 @@ from vllm.model_executor.models.registry import ModelRegistry
 # --- your custom imports ---
 from deepseek_ocr import DeepseekOCRForCausalLM
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, CROP_MODE
+from process.image_process import DeepseekOCRProcessor, count_views
+from process.page_stats import estimate_output_tokens, ink_ratio
+from process.result_cache import OCRResultCache
+from process.upload import (BufferPool, BufferReader, UploadError, decode_image_buffer, read_body,
+                            read_multipart, read_multipart_files)
+from process.preprocess_pool import Overloaded, PreprocessPool
+from process.pdf_render import render_page_image
+from process.job_store import JobStore
+from process.job_worker import JobWorker
+from process import metrics, profiling
+from config import (MODEL_PATH, CROP_MODE, MODEL_MODE, MIN_CROPS, MAX_CROPS, PROMPT,
+                    RESULT_CACHE_MAX_BYTES, RESULT_CACHE_DIR, MAX_UPLOAD_BYTES, UPLOAD_BUFFERS,
+                    PREPROCESS_WORKERS, PREPROCESS_MAX_PENDING, REQUEST_DEADLINE_SECONDS,
+                    MAX_BATCH_IMAGES, RENDER_DPI, MIN_RENDER_DPI, PDF_INFLIGHT_PAGES, JOB_DIR,
+                    JOB_INFLIGHT_TOKENS, PROFILE_DIR, PROFILE_MAX_SECONDS, ADMIN_TOKEN)
 
 # --- environment setup ---
 if torch.version.cuda == "11.8":
@@ -43,68 +61,817 @@ engine_args = AsyncEngineArgs(
 )
 engine = AsyncLLMEngine.from_engine_args(engine_args)
 
+# --- sampling settings (also part of the result cache key) ---
+SAMPLING_CONFIG = {
+    "temperature": 0.0,
+    "max_tokens": 8192,
+    "ngram_size": 30,
+    "window_size": 90,
+    "whitelist_token_ids": [128821, 128822],  # <td>, </td>
+}
+
+# --- OCR result cache ---
+result_cache = OCRResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_DIR)
+CACHE_MODE = f"{MODEL_MODE}:{MIN_CROPS}-{MAX_CROPS}"
+
+# --- reusable buffers for binary uploads ---
+upload_buffers = BufferPool(max_idle=UPLOAD_BUFFERS)
+
+# --- image decode and tiling run off the event loop, behind bounded admission ---
+def observe_preprocess(wait: float, run: float):
+    metrics.preprocess_queue_time.observe(wait)
+    metrics.preprocess_time.observe(run)
+
+
+preprocess_pool = PreprocessPool(PREPROCESS_WORKERS, PREPROCESS_MAX_PENDING, observe=observe_preprocess)
+metrics.requests_preprocessing.set_function(lambda: preprocess_pool.pending)
+
+# --- generations stopped before they finished (also deepseek_ocr:request_aborted_total) ---
+abort_stats = {"requests": 0, "tokens": 0, "disconnects": 0, "deadlines": 0}
+
+# --- durable job queue, enabled by JOB_DIR; the worker starts with the app ---
+job_store = JobStore(JOB_DIR) if JOB_DIR else None
+job_worker = None
+job_documents = {}  # job id -> open PyMuPDF document of the PDF job being rendered
+
+# --- latest on-demand profile (/admin/profile) ---
+profile_session = None
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
 # --- request model ---
 class OCRRequest(BaseModel):
     prompt: str
     image_base64: str
 
+
+class OCRBatchRequest(BaseModel):
+    prompt: str
+    images_base64: List[str]
+
 # --- helper functions ---
-def decode_base64_to_image(b64_string: str) -> Image.Image:
-    image_bytes = base64.b64decode(b64_string)
-    image = Image.open(io.BytesIO(image_bytes))
-    image = ImageOps.exif_transpose(image).convert("RGB")
-    return image
+async def read_ocr_request(request: Request, buffer):
+    """Read an OCR request body in any supported encoding; returns (prompt, image bytes).
 
+    - `image/*` or `application/octet-stream`: the raw image, prompt in the
+      `prompt` query parameter.
+    - `multipart/form-data`: a `file` part (or the first part with a filename)
+      and an optional `prompt` field.
+    - JSON `{"prompt", "image_base64"}` (anything else).
+
+    Binary bodies are streamed into `buffer` and the returned bytes are a
+    view of it, valid while the buffer is borrowed. Without a prompt, the
+    configured PROMPT is used.
+    """
+    content_type = request.headers.get("content-type", "")
+    media_type = content_type.split(";")[0].strip().lower()
+    if int(request.headers.get("content-length") or 0) > MAX_UPLOAD_BYTES:
+        raise UploadError(413, f"body exceeds {MAX_UPLOAD_BYTES} bytes")
+    prompt = request.query_params.get("prompt") or PROMPT
+
+    if media_type.startswith("image/") or media_type == "application/octet-stream":
+        await read_body(request.stream(), buffer, MAX_UPLOAD_BYTES)
+        return prompt, buffer.view()
+    if media_type == "multipart/form-data":
+        fields = await read_multipart(request.stream(), content_type, buffer, MAX_UPLOAD_BYTES)
+        return fields.get("prompt") or prompt, buffer.view()
+
+    try:
+        data = OCRRequest(**json.loads(await request.body()))
+        return data.prompt, base64.b64decode(data.image_base64)
+    except (ValueError, TypeError) as e:
+        raise UploadError(422, str(e))
 
-async def run_ocr(prompt: str, image: Image.Image) -> str:
-    # Convert image to model input features
-    image_features = (
-        DeepseekOCRProcessor().tokenize_with_images(
-            images=[image], bos=True, eos=True, cropping=CROP_MODE
-        )
-        if "<image>" in prompt
-        else ""
-    )
 
+def make_sampling_params() -> SamplingParams:
     logits_processors = [
         NoRepeatNGramLogitsProcessor(
-            ngram_size=30, window_size=90, whitelist_token_ids={128821, 128822}
+            ngram_size=SAMPLING_CONFIG["ngram_size"],
+            window_size=SAMPLING_CONFIG["window_size"],
+            whitelist_token_ids=set(SAMPLING_CONFIG["whitelist_token_ids"]),
         )
     ]
 
-    sampling_params = SamplingParams(
-        temperature=0.0,
-        max_tokens=8192,
+    return SamplingParams(
+        temperature=SAMPLING_CONFIG["temperature"],
+        max_tokens=SAMPLING_CONFIG["max_tokens"],
         logits_processors=logits_processors,
         skip_special_tokens=False,
     )
 
-    request_id = f"req-{int(time.time())}"
 
-    request = (
+def build_request(prompt: str, image: Image.Image) -> dict:
+    # Convert image to model input features
+    with profiling.stage("tokenize_with_images"):
+        image_features = (
+            DeepseekOCRProcessor().tokenize_with_images(
+                images=[image], bos=True, eos=True, cropping=CROP_MODE
+            )
+            if "<image>" in prompt
+            else ""
+        )
+    if image_features:
+        metrics.observe_image_features(image_features)
+
+    return (
         {"prompt": prompt, "multi_modal_data": {"image": image_features}}
         if "<image>" in prompt
         else {"prompt": prompt}
     )
 
+
+async def read_batch_request(request: Request, buffer):
+    """Read an `/ocr/batch` body; returns (prompt, list of image bytes in request order).
+
+    Multipart bodies carry one part with a filename per image (plus an
+    optional `prompt` field), streamed back to back into `buffer`; the
+    images are views of it. JSON bodies are `{"prompt", "images_base64": [...]}`.
+    """
+    content_type = request.headers.get("content-type", "")
+    media_type = content_type.split(";")[0].strip().lower()
+    if int(request.headers.get("content-length") or 0) > MAX_UPLOAD_BYTES:
+        raise UploadError(413, f"body exceeds {MAX_UPLOAD_BYTES} bytes")
+
+    if media_type == "multipart/form-data":
+        fields, images = await read_multipart_files(
+            request.stream(), content_type, buffer, MAX_UPLOAD_BYTES, MAX_BATCH_IMAGES)
+        prompt = fields.get("prompt") or request.query_params.get("prompt") or PROMPT
+    elif media_type in ("application/json", ""):
+        try:
+            data = OCRBatchRequest(**json.loads(await request.body()))
+            prompt, images = data.prompt, [base64.b64decode(image) for image in data.images_base64]
+        except (ValueError, TypeError) as e:
+            raise UploadError(422, str(e))
+    else:
+        raise UploadError(415, f"unsupported batch body type {media_type}")
+
+    if not images:
+        raise UploadError(400, "no images in the batch")
+    if len(images) > MAX_BATCH_IMAGES:
+        raise UploadError(413, f"more than {MAX_BATCH_IMAGES} images")
+    return prompt, images
+
+
+def prepare_inputs(prompt: str, image_bytes) -> dict:
+    """Decode and tile an upload into an engine request; runs on a preprocessing thread."""
+    with profiling.stage("decode"):
+        image = decode_image_buffer(image_bytes)
+    return build_request(prompt, image)
+
+
+def open_pdf(data):
+    return fitz.open(stream=data, filetype="pdf")
+
+
+def prepare_pdf_page(document, page_num: int, prompt: str) -> dict:
+    """Rasterize one PDF page at the resolution matched to the active mode and tile it.
+
+    PyMuPDF is not thread-safe: this, like every other fitz call, runs on
+    the preprocessing pool's serial thread (`run_serial`).
+    """
+    with profiling.stage("render"):
+        image = render_page_image(document[page_num], RENDER_DPI, MIN_RENDER_DPI)
+    return build_request(prompt, image)
+
+
+async def read_file_upload(request: Request, buffer, accepted) -> str:
+    """Stream a file upload into `buffer`; returns the prompt.
+
+    The body is either raw, with a media type starting with one of
+    `accepted` and the prompt in the query string, or multipart with a
+    `file` part and an optional `prompt` field.
+    """
+    content_type = request.headers.get("content-type", "")
+    media_type = content_type.split(";")[0].strip().lower()
+    if int(request.headers.get("content-length") or 0) > MAX_UPLOAD_BYTES:
+        raise UploadError(413, f"body exceeds {MAX_UPLOAD_BYTES} bytes")
+    prompt = request.query_params.get("prompt") or PROMPT
+    if media_type == "multipart/form-data":
+        fields = await read_multipart(request.stream(), content_type, buffer, MAX_UPLOAD_BYTES)
+        return fields.get("prompt") or prompt
+    if media_type.startswith(accepted):
+        await read_body(request.stream(), buffer, MAX_UPLOAD_BYTES)
+        return prompt
+    raise UploadError(415, f"unsupported body type {media_type}")
+
+
+def save_job_input(data):
+    """Store a job upload; returns (job id, kind).
+
+    PDFs are told apart from images by their header; an image's header is
+    checked here, a PDF is checked by `count_pdf_pages` once stored. Runs
+    on a preprocessing thread.
+    """
+    kind = "pdf" if bytes(data[:5]) == b"%PDF-" else "image"
+    if kind == "image":
+        try:
+            Image.open(BufferReader(data))  # reads the header only
+        except OSError:
+            raise UploadError(400, "not a readable image")
+    return job_store.save_input(data), kind
+
+
+def count_pdf_pages(path) -> int:
+    """Open a stored PDF job input; runs on the serial thread, like all PyMuPDF calls."""
+    try:
+        with fitz.open(path) as document:
+            num_pages = document.page_count
+    except RuntimeError:
+        raise UploadError(400, "not a readable PDF")
+    if num_pages == 0:
+        raise UploadError(400, "the PDF has no pages")
+    return num_pages
+
+
+def prepare_job_page(job: dict, page: int):
+    """Load and tile one page of a stored job; returns (engine request, estimated tokens).
+
+    The estimate, prompt length plus predicted output length (see
+    `estimate_output_tokens`), is what the job worker budgets with. Runs
+    on a preprocessing thread, the serial one for PDFs (see
+    `prepare_job_page_async`); the worker renders jobs oldest first, one
+    page at a time, so only the current PDF is kept open.
+    """
+    path = job_store.input_path(job["id"])
+    if job["kind"] == "pdf":
+        if job["id"] not in job_documents:
+            for document in job_documents.values():
+                document.close()
+            job_documents.clear()
+            job_documents[job["id"]] = fitz.open(path)
+        with profiling.stage("render"):
+            image = render_page_image(job_documents[job["id"]][page], RENDER_DPI, MIN_RENDER_DPI)
+    else:
+        with open(path, "rb") as f, profiling.stage("decode"):
+            image = decode_image_buffer(memoryview(f.read()))
+    engine_request = build_request(job["prompt"], image)
+    features = engine_request.get("multi_modal_data", {}).get("image")
+    prompt_tokens = features[0][0].shape[-1] if features else 0
+    return engine_request, prompt_tokens + estimate_output_tokens(ink_ratio(image), count_views(*image.size))
+
+
+def prepare_job_page_async(job: dict, page: int):
+    # PyMuPDF documents stay on the serial thread
+    run = preprocess_pool.run_serial if job["kind"] == "pdf" else preprocess_pool.run
+    return run(prepare_job_page, job, page)
+
+
+async def prepare_ocr_request(request: Request):
+    """Admit, read and preprocess one OCR request; returns (cache key, cached text, engine request).
+
+    On a result-cache hit nothing is decoded and the engine request is None.
+    Raises `Overloaded` when the preprocessing queue is full and
+    `UploadError` for bodies that cannot be used.
+    """
+    async with preprocess_pool.admit():
+        with upload_buffers.borrow() as buffer:
+            prompt, image_bytes = await read_ocr_request(request, buffer)
+            key = OCRResultCache.make_key(image_bytes, CACHE_MODE, prompt, SAMPLING_CONFIG)
+            cached = result_cache.get(key)
+            if cached is not None:
+                return key, cached, None
+            engine_request = await preprocess_pool.run(prepare_inputs, prompt, image_bytes)
+    return key, None, engine_request
+
+
+def overloaded_response(e: Overloaded) -> JSONResponse:
+    return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+
+
+def request_deadline(start: float):
+    """perf_counter time by which a request that arrived at `start` must be done, or None."""
+    return start + REQUEST_DEADLINE_SECONDS if REQUEST_DEADLINE_SECONDS > 0 else None
+
+
+async def generate_outputs(request: dict, deadline=None):
+    """Yield the engine's cumulative RequestOutputs for one request.
+
+    Raises `DeadlineExceeded` once `deadline` (perf_counter) passes. If the
+    request stops early for any reason (deadline, cancellation, consumer
+    closing the generator) it is aborted in the engine so its KV blocks are
+    freed at once, and the tokens it had decoded are counted in `abort_stats`.
+    Engine-side timings and token counts go to the Prometheus metrics.
+    """
+    request_id = f"req-{uuid.uuid4().hex}"
+    outputs = engine.generate(request, make_sampling_params(), request_id).__aiter__()
+    finished = False
+    tokens = 0
+    submitted, first = time.perf_counter(), None
+    metrics.requests_in_flight.inc()
+    try:
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            try:
+                result = await asyncio.wait_for(outputs.__anext__(), timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                abort_stats["deadlines"] += 1
+                metrics.count_abort("deadline")
+                raise DeadlineExceeded(f"no result within {REQUEST_DEADLINE_SECONDS:g}s")
+            if first is None:
+                first = time.perf_counter()
+                metrics.time_to_first_token.observe(first - submitted)
+            if result.outputs:
+                tokens = len(result.outputs[0].token_ids)
+            finished = result.finished
+            if finished:
+                metrics.decode_time.observe(time.perf_counter() - first)
+                metrics.generation_tokens.observe(tokens)
+                if result.outputs and result.outputs[0].finish_reason == "length":
+                    metrics.count_abort("repeat")
+            yield result
+    finally:
+        metrics.requests_in_flight.dec()
+        profiling.request_done()
+        if not finished:
+            await engine.abort(request_id)
+            abort_stats["requests"] += 1
+            abort_stats["tokens"] += tokens
+
+
+async def wait_for_disconnect(request: Request):
+    # once the body has been read, the next ASGI message is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def unless_disconnected(request: Request, work):
+    """Await `work`, cancelling it and raising `ClientDisconnected` if the client goes away first."""
+    work = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        # a watcher that failed (rather than saw the disconnect) just stops watching
+        if work.done() or watcher.exception() is not None:
+            return await work
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+    abort_stats["disconnects"] += 1
+    metrics.count_abort("disconnect")
+    raise ClientDisconnected()
+
+
+async def run_ocr(request: dict, deadline=None) -> str:
     final_output = ""
-    async for result in engine.generate(request, sampling_params, request_id):
+    async for result in generate_outputs(request, deadline):
         if result.outputs:
             final_output = result.outputs[0].text
     return final_output
 
 
+async def stream_ocr(request, key: str, start: float, preprocess: float, cached=None, deadline=None):
+    """Yield `{"text": delta}` records as tokens are decoded, then one final record.
+
+    The final record has `done`, token counts, `finish_reason`, `cached`,
+    and timings in seconds since `start` (when the request arrived):
+    `preprocess` (admission, body, image decode and tiling), `ttft` (first
+    text) and `total`. A cache hit (`cached`, no engine request) is sent as
+    a single delta; otherwise the generation is shared with identical
+    requests in flight and cached if it ends with "stop".
+    """
+    if cached is not None:
+        yield {"text": cached}
+        total = time.perf_counter() - start
+        yield {"done": True, "cached": True, "prompt_tokens": None, "completion_tokens": None,
+               "finish_reason": "stop", "preprocess": preprocess, "ttft": total, "total": total}
+        return
+
+    ttft = None
+    sent = 0
+    text, prompt_tokens, completion_tokens, finish_reason = "", None, 0, None
+    async for result in result_cache.stream(key, lambda: generate_outputs(request, deadline)):
+        if not result.outputs:
+            continue
+        completion = result.outputs[0]
+        text = completion.text
+        prompt_tokens = len(result.prompt_token_ids or ())
+        completion_tokens = len(completion.token_ids)
+        finish_reason = completion.finish_reason
+        if len(text) > sent:
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            yield {"text": text[sent:]}
+            sent = len(text)
+
+    yield {"done": True, "cached": False, "prompt_tokens": prompt_tokens,
+           "completion_tokens": completion_tokens, "finish_reason": finish_reason,
+           "preprocess": preprocess, "ttft": ttft, "total": time.perf_counter() - start}
+
+
 # --- endpoint ---
 @app.post("/ocr")
-async def ocr_endpoint(data: OCRRequest):
+async def ocr_endpoint(request: Request):
+    """OCR one image sent as JSON (base64), a raw `image/*` body or a multipart upload.
+
+    If the client disconnects before the text is ready, its wait is
+    cancelled; the generation is aborted unless another request shares it.
+    """
+    deadline = request_deadline(time.perf_counter())
     try:
-        image = decode_base64_to_image(data.image_base64)
-        output_text = await run_ocr(data.prompt, image)
+        key, output_text, engine_request = await prepare_ocr_request(request)
+        if output_text is None:
+            output_text = await unless_disconnected(
+                request, result_cache.get_or_compute(key, lambda: generate_outputs(engine_request, deadline))
+            )
         return {"text_output": output_text}
+    except DeadlineExceeded as e:
+        return JSONResponse({"error": str(e)}, status_code=504)
+    except ClientDisconnected:
+        # nobody is listening; 499 only shows up in the access log
+        return JSONResponse({"error": "client disconnected"}, status_code=499)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except UploadError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
+@app.post("/ocr/stream")
+async def ocr_stream_endpoint(request: Request, format: Literal["ndjson", "sse"] = "ndjson"):
+    """Stream `/ocr` as it decodes: NDJSON lines, or server-sent events with `format=sse`.
+
+    Takes the same bodies as `/ocr`. Every record is a JSON object:
+    `{"text": ...}` deltas, then one record with `"done": true` (see
+    `stream_ocr`), or `{"error": ...}` if the request fails after the
+    response has started.
+    """
+    start = time.perf_counter()
+    try:
+        # preprocessing finishes before the response starts, so errors still get a status code
+        key, cached, engine_request = await prepare_ocr_request(request)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except UploadError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    preprocess = time.perf_counter() - start
+
+    if format == "sse":
+        media_type = "text/event-stream"
+        frame = lambda record: f"data: {json.dumps(record, ensure_ascii=False)}\n\n"
+    else:
+        media_type = "application/x-ndjson"
+        frame = lambda record: json.dumps(record, ensure_ascii=False) + "\n"
+
+    async def body():
+        try:
+            async for record in stream_ocr(engine_request, key, start, preprocess, cached,
+                                           request_deadline(start)):
+                yield frame(record)
+        except (asyncio.CancelledError, GeneratorExit):
+            # the client went away: the server cancels or closes this body, which aborts the generation
+            abort_stats["disconnects"] += 1
+            metrics.count_abort("disconnect")
+            raise
+        except Exception as e:
+            yield frame({"error": str(e)})
+
+    # no-transform / X-Accel-Buffering keep proxies from holding back the deltas
+    headers = {"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"}
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
+
+
+@app.post("/ocr/batch")
+async def ocr_batch_endpoint(request: Request):
+    """OCR many images in one request (see `read_batch_request` for the body).
+
+    All images are preprocessed in parallel and submitted to the engine
+    together, so they are decoded in the same batches. The response is
+    NDJSON with one record per image in request order, each sent as soon
+    as it and every image before it are done: `{"index", "text", "cached",
+    "seconds"}` or `{"index", "error"}`. A final `{"done": true, "pages",
+    "errors", "total"}` record closes it.
+    """
+    start = time.perf_counter()
+    deadline = request_deadline(start)
+    try:
+        async with preprocess_pool.admit():
+            with upload_buffers.borrow() as buffer:
+                prompt, images = await read_batch_request(request, buffer)
+                try:
+                    keys = [OCRResultCache.make_key(image, CACHE_MODE, prompt, SAMPLING_CONFIG) for image in images]
+                    pages = [result_cache.get(key) for key in keys]
+                    misses = [index for index, page in enumerate(pages) if page is None]
+                    # the batch already holds one slot; the rest of its images take one each, before any decode
+                    async with preprocess_pool.admit(max(0, len(misses) - 1)):
+                        prepared = await asyncio.gather(
+                            *(preprocess_pool.run(prepare_inputs, prompt, images[index]) for index in misses),
+                            return_exceptions=True)
+                finally:
+                    # a view kept alive (say by a stored exception's traceback) would pin the pooled buffer
+                    for image in images:
+                        if isinstance(image, memoryview):
+                            image.release()
+    except Overloaded as e:
+        return overloaded_response(e)
+    except UploadError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    # submit every page now, in one go; the body only waits on them in order
+    for index, engine_request in zip(misses, prepared):
+        if isinstance(engine_request, Exception):
+            pages[index] = engine_request
+        else:
+            pages[index] = asyncio.ensure_future(result_cache.get_or_compute(
+                keys[index], lambda engine_request=engine_request: generate_outputs(engine_request, deadline)))
+
+    async def body():
+        errors = 0
+        try:
+            for index, page in enumerate(pages):
+                record = {"index": index}
+                try:
+                    if isinstance(page, Exception):
+                        raise page
+                    if isinstance(page, str):
+                        record.update(text=page, cached=True)
+                    else:
+                        record.update(text=await page, cached=False)
+                    record["seconds"] = time.perf_counter() - start
+                except Exception as e:
+                    errors += 1
+                    record["error"] = str(e)
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "pages": len(pages), "errors": errors,
+                              "total": time.perf_counter() - start}) + "\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            abort_stats["disconnects"] += 1
+            metrics.count_abort("disconnect")
+            raise
+        finally:
+            # pages nobody will read: cancelling the waits aborts their generations
+            for page in pages:
+                if isinstance(page, asyncio.Future) and not page.done():
+                    page.cancel()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+
+
+@app.post("/ocr/pdf")
+async def ocr_pdf_endpoint(request: Request):
+    """OCR a whole PDF sent as `application/pdf` (or octet-stream) or a multipart `file`.
+
+    Pages are rasterized on the server with PyMuPDF, one after another on
+    the preprocessing pool's serial thread, and each goes to the engine as
+    soon as it is rendered, so rasterization overlaps decoding. At most
+    PDF_INFLIGHT_PAGES pages are rendered ahead of the page being waited
+    on. The response is NDJSON in page order: `{"page", "text", "seconds"}`
+    or `{"page", "error"}`, then `{"done": true, "pages", "errors", "total"}`.
+    The deadline applies to each page from when it is submitted.
+    """
+    start = time.perf_counter()
+    stack = contextlib.AsyncExitStack()
+    try:
+        # the admission slot is held until the last page is rendered
+        await stack.enter_async_context(preprocess_pool.admit())
+        with upload_buffers.borrow() as buffer:
+            prompt = await read_file_upload(request, buffer, ("application/pdf", "application/octet-stream"))
+            # PyMuPDF keeps the memory it reads from exported even after close(), which would stop
+            # the pooled buffer from ever growing again: the document gets its own copy
+            data = bytes(buffer.view())
+        try:
+            document = await preprocess_pool.run_serial(open_pdf, data)
+        except RuntimeError as e:
+            raise UploadError(400, f"not a readable PDF: {e}")
+        stack.push_async_callback(preprocess_pool.run_serial, document.close)
+    except Overloaded as e:
+        await stack.aclose()
+        return overloaded_response(e)
+    except UploadError as e:
+        await stack.aclose()
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except BaseException:
+        await stack.aclose()
+        raise
+
+    pages = asyncio.Queue(maxsize=PDF_INFLIGHT_PAGES)
+
+    async def produce():
+        try:
+            for page_num in range(document.page_count):
+                try:
+                    engine_request = await preprocess_pool.run_serial(prepare_pdf_page, document, page_num, prompt)
+                    page = asyncio.ensure_future(
+                        run_ocr(engine_request, request_deadline(time.perf_counter())))
+                except Exception as e:
+                    page = e
+                try:
+                    await pages.put(page)
+                except asyncio.CancelledError:
+                    if isinstance(page, asyncio.Future):
+                        page.cancel()
+                    raise
+        finally:
+            await stack.aclose()
+        await pages.put(None)
+
+    producer = asyncio.ensure_future(produce())
+
+    async def body():
+        count = errors = 0
+        try:
+            while (page := await pages.get()) is not None:
+                record = {"page": count}
+                try:
+                    if isinstance(page, Exception):
+                        raise page
+                    record["text"] = await page
+                    record["seconds"] = time.perf_counter() - start
+                except Exception as e:
+                    errors += 1
+                    record["error"] = str(e)
+                count += 1
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "pages": count, "errors": errors,
+                              "total": time.perf_counter() - start}) + "\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            abort_stats["disconnects"] += 1
+            metrics.count_abort("disconnect")
+            raise
+        finally:
+            # stop rendering and abort the pages already submitted
+            producer.cancel()
+            while not pages.empty():
+                page = pages.get_nowait()
+                if isinstance(page, asyncio.Future):
+                    page.cancel()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+
+
+def jobs_disabled() -> JSONResponse:
+    return JSONResponse({"error": "the job queue is disabled; set JOB_DIR"}, status_code=503)
+
+
+@app.on_event("startup")
+async def start_job_worker():
+    # resumes the jobs a previous process left queued or running
+    global job_worker
+    if job_store is not None:
+        job_worker = JobWorker(job_store, prepare_job_page_async, generate_outputs, JOB_INFLIGHT_TOKENS)
+        job_worker.start()
+
+
+@app.post("/jobs")
+async def submit_job(request: Request):
+    """Queue a PDF or an image for OCR in the background; answers 202 `{"job_id", "status", "pages"}`.
+
+    Takes a raw `application/pdf`, `image/*` or octet-stream body, or a
+    multipart `file`, with an optional prompt as for `/ocr/pdf`. The upload
+    is on disk before the job is acknowledged, and jobs survive restarts,
+    resuming after their last finished page. Poll `GET /jobs/{id}` and
+    fetch `GET /jobs/{id}/result` once it is done.
+    """
+    if job_store is None:
+        return jobs_disabled()
+    try:
+        async with preprocess_pool.admit():
+            with upload_buffers.borrow() as buffer:
+                prompt = await read_file_upload(request, buffer,
+                                                ("application/pdf", "application/octet-stream", "image/"))
+                job_id, kind = await preprocess_pool.run(save_job_input, buffer.view())
+            num_pages = 1
+            if kind == "pdf":
+                try:
+                    num_pages = await preprocess_pool.run_serial(count_pdf_pages, job_store.input_path(job_id))
+                except BaseException:
+                    job_store.discard_input(job_id)
+                    raise
+    except Overloaded as e:
+        return overloaded_response(e)
+    except UploadError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    await asyncio.to_thread(job_store.create_job, job_id, kind, prompt, num_pages)
+    await job_worker.notify(job_id)
+    return JSONResponse({"job_id": job_id, "status": "queued", "pages": num_pages}, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a job: `status` (queued, running, done, cancelled), `pages_done` of `num_pages`."""
+    if job_store is None:
+        return jobs_disabled()
+    job = await asyncio.to_thread(job_store.get_job, job_id)
+    if job is None:
+        return JSONResponse({"error": "no such job"}, status_code=404)
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, partial: bool = False):
+    """The pages of a finished job in order: `{"page", "text" or "error", "timings"}`.
+
+    `timings` are in seconds: `queue_wait` (submitted to picked up),
+    `preprocess`, `encode` (submitted to the engine to first token) and
+    `decode`, plus token counts. Answers 409 while the job is still
+    active unless `partial=true`, which returns the pages finished so far.
+    """
+    if job_store is None:
+        return jobs_disabled()
+    job = await asyncio.to_thread(job_store.get_job, job_id)
+    if job is None:
+        return JSONResponse({"error": "no such job"}, status_code=404)
+    if job["status"] != "done" and not partial:
+        return JSONResponse({"error": f"job is {job['status']}", "status": job["status"]}, status_code=409)
+    # reads one file per page
+    pages = await asyncio.to_thread(job_store.page_results, job_id)
+    return {"job_id": job_id, "status": job["status"], "pages": pages}
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; pages in the engine are aborted, finished ones are kept."""
+    if job_store is None:
+        return jobs_disabled()
+    if await asyncio.to_thread(job_store.get_job, job_id) is None:
+        return JSONResponse({"error": "no such job"}, status_code=404)
+    await job_worker.cancel(job_id)
+    return await asyncio.to_thread(job_store.get_job, job_id)
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "result_cache": result_cache.stats(),
+        "upload_buffers": upload_buffers.stats(),
+        "preprocess": preprocess_pool.stats(),
+        "aborted": abort_stats,
+        "jobs": job_worker.stats() if job_worker is not None else None,
+    }
+
+
+def admin_error(request: Request):
+    """The response refusing an admin request, or None if it may go ahead."""
+    if not PROFILE_DIR or not ADMIN_TOKEN:
+        return JSONResponse({"error": "profiling is disabled; set PROFILE_DIR and ADMIN_TOKEN"}, status_code=503)
+    if not hmac.compare_digest(request.headers.get("authorization", "").encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        return JSONResponse({"error": "admin token required"}, status_code=401)
+    return None
+
+
+@app.post("/admin/profile")
+async def start_profile(request: Request, requests: int = 0, seconds: float = 0):
+    """Profile the next `requests` generations or `seconds` seconds, whichever ends first.
+
+    Captures `torch.profiler` (CPU and CUDA) together with the stage timers
+    (decode/render, tokenize_with_images, sam, clip, projector, llm) and
+    writes them to a new directory under PROFILE_DIR (see
+    `ProfileSession`). No capture runs longer than PROFILE_MAX_SECONDS.
+    Answers 202 with the session status, which `GET /admin/profile` polls;
+    409 while another capture is running.
+    """
+    global profile_session
+    refused = admin_error(request)
+    if refused is not None:
+        return refused
+    if requests <= 0 and seconds <= 0:
+        return JSONResponse({"error": "set requests or seconds"}, status_code=400)
+    if profile_session is not None and profile_session.state in ("capturing", "writing"):
+        return JSONResponse({"error": "a profile is already being captured", **profile_session.status()},
+                            status_code=409)
+    directory = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S"))
+    max_seconds = min(seconds, PROFILE_MAX_SECONDS) if seconds > 0 else PROFILE_MAX_SECONDS
+    profile_session = profiling.ProfileSession(directory, requests or None, max_seconds)
+    asyncio.ensure_future(profile_session.run())
+    await asyncio.sleep(0)  # let the capture start before answering
+    return JSONResponse(profile_session.status(), status_code=202)
+
+
+@app.get("/admin/profile")
+async def profile_status(request: Request):
+    refused = admin_error(request)
+    if refused is not None:
+        return refused
+    if profile_session is None:
+        return JSONResponse({"error": "no profile captured yet"}, status_code=404)
+    return profile_session.status()
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics: this server's `deepseek_ocr:*` plus the engine's `vllm:*`."""
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
+
@@ -0,0 +1,75 @@
+"""Send images to a warm `run_dpsk_ocr_image.py --serve` daemon and stream the text back.
+
+Only the standard library is imported, so a call costs preprocessing plus
+decode instead of a model load. Results are saved by the daemon exactly as
+a one-shot run saves them (result.mmd, result_ori.mmd, images/, ...).
+
+    python run_dpsk_ocr_image.py --serve &
+    python ocr_client.py page1.jpg page2.jpg -o output/ [--prompt '<image>\\nFree OCR.']
+
+With several images and -o, each goes to its own subdirectory of the output;
+without -o, the daemon makes a new directory per image in its OUTPUT_PATH.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+OCR_SOCKET = os.getenv("OCR_SOCKET", "/tmp/deepseek-ocr.sock")
+
+
+def ocr(image_path, sock_file, prompt=None, output_path=None, on_text=None):
+    """Send one request over an open connection; returns the daemon's final record."""
+    # the daemon resolves paths from its own working directory
+    job = {'image': os.path.abspath(image_path)}
+    if prompt:
+        job['prompt'] = prompt
+    if output_path:
+        job['output'] = os.path.abspath(output_path)
+    sock_file.write((json.dumps(job) + '\n').encode('utf-8'))
+    sock_file.flush()
+
+    for line in sock_file:
+        message = json.loads(line)
+        if 'text' in message:
+            if on_text is not None:
+                on_text(message['text'])
+            continue
+        return message
+    raise ConnectionError('daemon closed the connection')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('-o', '--output', default=None, help="output directory, inside the daemon's OUTPUT_PATH (default: a new one there per image)")
+    parser.add_argument('--prompt', default=None, help="prompt (default: the daemon's PROMPT)")
+    parser.add_argument('--socket', default=OCR_SOCKET)
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not echo the text as it is decoded')
+    args = parser.parse_args()
+
+    def echo(text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    failed = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.socket)
+        with sock.makefile('rwb') as sock_file:
+            for image_path in args.images:
+                output_path = args.output
+                if output_path and len(args.images) > 1:
+                    output_path = os.path.join(output_path, os.path.splitext(os.path.basename(image_path))[0])
+                result = ocr(image_path, sock_file, args.prompt, output_path, None if args.quiet else echo)
+                if 'error' in result:
+                    failed += 1
+                    print(f'\n{image_path}: {result["error"]}', file=sys.stderr)
+                else:
+                    print(f'\n{image_path}: {result["seconds"]:.2f}s '
+                          f'(preprocess {result["preprocess_seconds"]:.2f}s) -> {result["output"]}', file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,11 @@ import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
+from config import (IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER,
+                    VISION_CACHE_GPU_MB, VISION_CACHE_CPU_MB)
+from process.vision_cache import image_digest
+
+VISION_CACHE_ENABLED = VISION_CACHE_GPU_MB > 0 or VISION_CACHE_CPU_MB > 0
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
@@ -42,6 +46,14 @@ def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, i
     return target_aspect_ratio
 
 
+def count_views(width, height, cropping=CROP_MODE):
+    """Number of vision views for a width x height image: the crop tiles plus the global view."""
+    if not cropping or (width <= 640 and height <= 640):
+        return 1
+    cols, rows = count_tiles(width, height, image_size=IMAGE_SIZE)
+    return cols * rows + 1
+
+
 def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
@@ -269,7 +281,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         sft_format = prompt
 
-        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _ = images[0]
+        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_hashes, _ = images[0]
 
 
         return {
@@ -279,6 +291,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
             "images_seq_mask": images_seq_mask,
             "images_spatial_crop": images_spatial_crop,
             "num_image_tokens": num_image_tokens,
+            "image_hashes": image_hashes,
         }
 
 
@@ -343,6 +356,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
         text_splits = conversation.split(self.image_token)
         images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
         image_shapes = []
+        image_hashes = []
         num_image_tokens = []
         tokenized_str = []
         # print('image: ', len(images))
@@ -359,6 +373,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
             #     best_width, best_height = self.image_size, self.image_size
 
             image_shapes.append(image.size)
+            # content key for the model-side vision embedding cache
+            image_hashes.append(image_digest(image) if VISION_CACHE_ENABLED else torch.zeros(2, dtype=torch.long))
 
             if image.size[0] <= 640 and image.size[1] <= 640:
                 crop_ratio = [1, 1]
@@ -484,10 +500,12 @@ class DeepseekOCRProcessor(ProcessorMixin):
         if len(images_list) == 0:
             pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
             images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
+            image_hashes = torch.zeros((1, 2), dtype=torch.long)
             images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
             images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
+            image_hashes = torch.stack(image_hashes, dim=0)
             if images_crop_list:
                 images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
             else:
@@ -496,7 +514,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
         input_ids = input_ids.unsqueeze(0)
 
         
-        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
+        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_hashes, image_shapes]]
 
 
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
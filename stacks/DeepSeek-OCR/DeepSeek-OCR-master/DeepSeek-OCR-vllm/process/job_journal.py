@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+
+
+def job_fingerprint(input_path, settings):
+    """Identity of a job: the input file (size, mtime) plus every setting that changes its output."""
+    stat = os.stat(input_path)
+    payload = json.dumps({
+        "input": os.path.abspath(input_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "settings": settings,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JobJournal:
+    """Append-only JSONL record of finished pages, so a killed job can resume.
+
+    The first line is a header holding the job fingerprint; every further
+    line is one page: `{"page": i, "status": ..., "det": ...}` where `det` is
+    the page content as it goes into `_det.mmd` (the `.mmd` content is derived
+    from it deterministically). Each record is flushed and fsynced before
+    `record` returns. On open, a journal written for a different fingerprint
+    is discarded, and a torn last line (the process died mid-write) is cut off.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.done = {}
+
+        valid_bytes = self._load() if os.path.exists(path) else 0
+        self._file = open(path, "r+b" if valid_bytes else "wb")
+        self._file.truncate(valid_bytes)
+        self._file.seek(valid_bytes)
+        if not valid_bytes:
+            self._append({"fingerprint": fingerprint})
+
+    def _load(self):
+        """Read finished pages; returns the byte length of the valid prefix (0 to start over)."""
+        valid_bytes = 0
+        with open(self.path, "rb") as afile:
+            for line_num, line in enumerate(afile):
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("truncated record")
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if line_num == 0:
+                    if record.get("fingerprint") != self.fingerprint:
+                        return 0
+                else:
+                    self.done[record["page"]] = record
+                valid_bytes += len(line)
+        return valid_bytes
+
+    def _append(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, page_idx, status, det=""):
+        record = {"page": page_idx, "status": status, "det": det}
+        self._append(record)
+        self.done[page_idx] = record
+
+    def get(self, page_idx):
+        return self.done.get(page_idx)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
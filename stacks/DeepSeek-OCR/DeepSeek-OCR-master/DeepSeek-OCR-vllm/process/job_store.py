@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    num_pages INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    job_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    timings TEXT NOT NULL,
+    PRIMARY KEY (job_id, page)
+);
+"""
+
+ACTIVE = ("queued", "running")
+
+
+class JobStore:
+    """Durable state of asynchronous OCR jobs: SQLite plus a directory per job.
+
+    `<directory>/jobs.sqlite3` holds the job and page rows;
+    `<directory>/<job id>/` holds the uploaded input and one `page_<n>.mmd`
+    per finished page, written before its row is committed. A page counts
+    as finished only once its row exists, so after a restart a job resumes
+    from the pages that were committed. Safe to use from any thread: the
+    connection is behind a lock, so writes can run off the event loop.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "jobs.sqlite3"), isolation_level=None,
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def input_path(self, job_id):
+        return os.path.join(self._job_dir(job_id), "input")
+
+    def _page_path(self, job_id, page):
+        return os.path.join(self._job_dir(job_id), f"page_{page}.mmd")
+
+    def save_input(self, data):
+        """Write an upload to a new job directory; returns the new job id.
+
+        Touches only the filesystem, so it may run on a worker thread.
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self._job_dir(job_id))
+        with open(self.input_path(job_id), "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return job_id
+
+    def discard_input(self, job_id):
+        """Remove a stored upload that was never queued."""
+        shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+
+    def create_job(self, job_id, kind, prompt, num_pages):
+        """Queue a job whose input `save_input` has stored."""
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, prompt, num_pages, status, created) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, kind, prompt, num_pages, time.time()))
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            counts = self._db.execute(
+                "SELECT COUNT(*), SUM(status = 'error') FROM pages WHERE job_id = ?", (job_id,)).fetchone()
+        job = dict(row)
+        job["pages_done"] = counts[0]
+        job["page_errors"] = counts[1] or 0
+        return job
+
+    def active_jobs(self):
+        """Queued and running jobs, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM jobs WHERE status IN {ACTIVE} ORDER BY created").fetchall()
+        return [dict(row) for row in rows]
+
+    def done_pages(self, job_id):
+        with self._lock:
+            rows = self._db.execute("SELECT page FROM pages WHERE job_id = ?", (job_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def start_job(self, job_id):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = 'running', started = COALESCE(started, ?) WHERE id = ? AND "
+                             f"status IN {ACTIVE}", (time.time(), job_id))
+
+    def record_page(self, job_id, page, text=None, error=None, timings=None):
+        """Persist one page: the text file first, then the row that marks it finished."""
+        if error is None:
+            path = self._page_path(job_id, page)
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(f"{path}.tmp", path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages (job_id, page, status, error, timings) VALUES (?, ?, ?, ?, ?)",
+                (job_id, page, "ok" if error is None else "error", error, json.dumps(timings or {})))
+
+    def finish_job(self, job_id, status, error=None):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ? AND status IN "
+                             f"{ACTIVE}", (status, error, time.time(), job_id))
+
+    def page_results(self, job_id):
+        """Finished pages in page order: {"page", "text" or "error", "timings"}."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT page, status, error, timings FROM pages WHERE job_id = ? ORDER BY page",
+                (job_id,)).fetchall()
+        pages = []
+        for row in rows:
+            page = {"page": row["page"]}
+            if row["status"] == "ok":
+                with open(self._page_path(job_id, row["page"]), encoding="utf-8") as f:
+                    page["text"] = f.read()
+            else:
+                page["error"] = row["error"]
+            page["timings"] = json.loads(row["timings"])
+            pages.append(page)
+        return pages
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorker:
+    """Feeds the pages of queued jobs to the engine, bounded by an in-flight token budget.
+
+    Pages are prepared one at a time, oldest job first, with
+    `prepare_page(job, page) -> (engine request, estimated tokens)`.
+    Each is submitted as soon as the tokens of the pages already in flight
+    plus its own estimate fit in `token_budget` (a page that is alone never
+    waits). That way the engine always has work queued, but never so much
+    that it preempts. `generate(request)` is the engine's async iterator of
+    cumulative outputs. Every finished page is committed to the `JobStore`
+    on a worker thread, so SQLite and file writes never block the event
+    loop. On start, jobs left queued or running by a previous process
+    resume from their first uncommitted page. A failure outside a page is
+    logged and the loop carries on; if the loop dies anyway, it is logged
+    and restarted.
+
+    Per page it records: `queue_wait` (job submitted to page picked up),
+    `preprocess` (render and tiling), `encode` (submitted to first token:
+    engine queue, vision encoder and prefill), `decode` (first to last
+    token), and token counts.
+    """
+
+    def __init__(self, store, prepare_page, generate, token_budget):
+        self.store = store
+        self.prepare_page = prepare_page
+        self.generate = generate
+        self.token_budget = token_budget
+        self.inflight_tokens = 0
+        self._jobs = {}      # job id -> [job row, iterator over its remaining pages, pages outstanding]
+        self._tasks = {}     # job id -> set of page tasks
+        self._wakeup = asyncio.Event()
+        self._runner = None
+
+    def start(self):
+        for job in self.store.active_jobs():
+            if not self._add(job, self.store.done_pages(job["id"])):
+                # every page was committed before the last shutdown
+                self.store.finish_job(job["id"], "done")
+                del self._jobs[job["id"]]
+        self._spawn_runner()
+
+    def _spawn_runner(self):
+        self._runner = asyncio.ensure_future(self._run())
+        self._runner.add_done_callback(self._runner_done)
+
+    def _runner_done(self, task):
+        if task.cancelled():
+            return
+        logger.error("job worker loop died, restarting it", exc_info=task.exception())
+        asyncio.get_running_loop().call_later(1.0, self._spawn_runner)
+
+    async def notify(self, job_id):
+        """Pick up a job that was just created in the store."""
+        job = await asyncio.to_thread(self.store.get_job, job_id)
+        self._add(job, set())
+        self._wakeup.set()
+
+    async def cancel(self, job_id):
+        self._jobs.pop(job_id, None)
+        for task in self._tasks.pop(job_id, ()):
+            task.cancel()
+        await asyncio.to_thread(self.store.finish_job, job_id, "cancelled")
+
+    def stats(self):
+        return {
+            "active_jobs": len(self._jobs),
+            "pages_in_flight": sum(len(tasks) for tasks in self._tasks.values()),
+            "inflight_tokens": self.inflight_tokens,
+            "token_budget": self.token_budget,
+        }
+
+    def _add(self, job, done):
+        """Track a job whose pages `done` are committed; returns whether it has pages left to run."""
+        remaining = [page for page in range(job["num_pages"]) if page not in done]
+        self._jobs[job["id"]] = [job, iter(remaining), len(remaining)]
+        return bool(remaining)
+
+    def _next_page(self):
+        for job_id, (job, pages, _) in self._jobs.items():
+            page = next(pages, None)
+            if page is not None:
+                return job, page
+        return None
+
+    async def _wait(self):
+        self._wakeup.clear()
+        await self._wakeup.wait()
+
+    async def _run(self):
+        while True:
+            claim = self._next_page()
+            if claim is None:
+                await self._wait()
+                continue
+            job, page = claim
+            try:
+                await self._submit(job, page)
+            except Exception as e:
+                logger.exception("job %s: could not submit page %d", job["id"], page)
+                await self._page_done(job["id"], page, error=f"submission failed: {e}", timings={})
+
+    async def _submit(self, job, page):
+        if job["status"] == "queued":
+            await asyncio.to_thread(self.store.start_job, job["id"])
+            job["status"] = "running"
+
+        timings = {"queue_wait": time.time() - job["created"]}
+        start = time.perf_counter()
+        try:
+            request, estimate = await self.prepare_page(job, page)
+        except Exception as e:
+            await self._page_done(job["id"], page, error=f"preprocessing failed: {e}", timings=timings)
+            return
+        timings["preprocess"] = time.perf_counter() - start
+
+        while self.inflight_tokens and self.inflight_tokens + estimate > self.token_budget:
+            await self._wait()
+        if job["id"] not in self._jobs:
+            return  # cancelled while it waited
+
+        self.inflight_tokens += estimate
+        task = asyncio.ensure_future(self._run_page(job["id"], page, request, timings))
+        self._tasks.setdefault(job["id"], set()).add(task)
+        task.add_done_callback(lambda task, job_id=job["id"], estimate=estimate:
+                               self._release(job_id, task, estimate))
+
+    def _release(self, job_id, task, estimate):
+        self.inflight_tokens -= estimate
+        self._tasks.get(job_id, set()).discard(task)
+        self._wakeup.set()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("job %s: page task failed", job_id, exc_info=task.exception())
+
+    async def _run_page(self, job_id, page, request, timings):
+        submitted = time.perf_counter()
+        first = None
+        text, completion = "", None
+        try:
+            async for result in self.generate(request):
+                if first is None:
+                    first = time.perf_counter()
+                if result.outputs:
+                    completion = result.outputs[0]
+                    text = completion.text
+                    timings["prompt_tokens"] = len(result.prompt_token_ids or ())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._page_done(job_id, page, error=f"generation failed: {e}", timings=timings)
+            return
+        finished = time.perf_counter()
+        timings["encode"] = (first or finished) - submitted
+        timings["decode"] = finished - (first or finished)
+        if completion is not None:
+            timings["completion_tokens"] = len(completion.token_ids)
+            timings["finish_reason"] = completion.finish_reason
+        await self._page_done(job_id, page, text=text, timings=timings)
+
+    async def _page_done(self, job_id, page, text=None, error=None, timings=None):
+        if job_id not in self._jobs:
+            return  # cancelled
+        try:
+            await asyncio.to_thread(self.store.record_page, job_id, page, text=text, error=error, timings=timings)
+        except Exception:
+            # left uncommitted: the job stays running and redoes the page after a restart
+            logger.exception("job %s: could not record page %d", job_id, page)
+            return
+        entry = self._jobs.get(job_id)
+        if entry is None:
+            return  # cancelled while it was written
+        entry[2] -= 1
+        if entry[2] == 0:
+            await self._finish(job_id)
+
+    async def _finish(self, job_id):
+        self._jobs.pop(job_id, None)
+        try:
+            await asyncio.to_thread(self.store.finish_job, job_id, "done")
+        except Exception:
+            # every page is committed, so the next start finishes it
+            logger.exception("job %s: could not mark it done", job_id)
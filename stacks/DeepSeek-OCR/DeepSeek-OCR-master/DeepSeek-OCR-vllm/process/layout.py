@@ -0,0 +1,82 @@
+import json
+import re
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from process.markdown_post import REF_PATTERN
+
+# payloads are lists of [x1, y1, x2, y2] on the model's 0-999 grid
+_BOX = r'\[\s*\d{1,4}\s*,\s*\d{1,4}\s*,\s*\d{1,4}\s*,\s*\d{1,4}\s*\]'
+_DET_PAYLOAD = re.compile(rf'\s*\[\s*{_BOX}(?:\s*,\s*{_BOX})*\s*,?\s*\]\s*')
+_NUMBER = re.compile(r'\d+')
+
+
+class LayoutBlock(NamedTuple):
+    label: str
+    boxes: np.ndarray  # (k, 4) int16, 0-999 grid
+    span: tuple        # offsets of the <|ref|>...<|/det|> tag
+    text: tuple        # offsets of the block text that follows it (whitespace trimmed)
+
+
+def parse_det(payload) -> Optional[np.ndarray]:
+    """Boxes of a `<|det|>` payload as a (k, 4) int16 array, or None if it is malformed."""
+    if not _DET_PAYLOAD.fullmatch(payload):
+        return None
+    return np.array(_NUMBER.findall(payload), dtype=np.int16).reshape(-1, 4)
+
+
+def parse_layout(content):
+    """Every well-formed ref in a page's raw output, with its boxes and text offsets."""
+    matches = list(REF_PATTERN.finditer(content))
+    blocks = []
+    for i, match in enumerate(matches):
+        boxes = parse_det(match.group(3))
+        if boxes is None:
+            continue
+
+        text_start = match.end()
+        text_end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        body = content[text_start:text_end]
+        stripped = body.strip()
+        if stripped:
+            text_start += len(body) - len(body.lstrip())
+            text_end = text_start + len(stripped)
+        else:
+            text_end = text_start
+
+        blocks.append(LayoutBlock(match.group(2), boxes, (match.start(), match.end()), (text_start, text_end)))
+    return blocks
+
+
+def pixel_boxes(boxes, width, height):
+    """Grid boxes scaled to a `width` x `height` image, truncated like the layout drawing."""
+    scale = np.array([width, height, width, height], dtype=np.float64)
+    return (boxes / 999 * scale).astype(np.int64)
+
+
+def layout_record(blocks, width, height, page, offset=0):
+    """JSON-ready layout of one page.
+
+    `span`/`text` are character offsets into the `_det.mmd` file, `offset`
+    being where the page starts in it; `boxes` are normalized to [0, 1].
+    """
+    return {
+        'page': page,
+        'width': width,
+        'height': height,
+        'offset': offset,
+        'blocks': [{
+            'label': block.label,
+            'boxes': np.round(block.boxes / 999, 4).tolist(),
+            'pixel_boxes': pixel_boxes(block.boxes, width, height).tolist(),
+            'span': [offset + block.span[0], offset + block.span[1]],
+            'text': [offset + block.text[0], offset + block.text[1]],
+        } for block in blocks],
+    }
+
+
+def read_layout(path):
+    """Page records of a `_layout.jsonl` file."""
+    with open(path, encoding='utf-8') as afile:
+        return [json.loads(line) for line in afile if line.strip()]
@@ -0,0 +1,147 @@
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+def crop_figures(image, blocks, path_prefix):
+    """Save every `image` box as `{path_prefix}{idx}.jpg`, numbered in reading order."""
+    img_idx = 0
+    for label, pixel_boxes in blocks:
+        if label != 'image':
+            continue
+        for x1, y1, x2, y2 in pixel_boxes:
+            try:
+                image.crop((x1, y1, x2, y2)).save(f'{path_prefix}{img_idx}.jpg')
+            except Exception as e:
+                print(e)
+            img_idx += 1
+
+
+def draw_layout(image, blocks, seed=0):
+    """Copy of `image` with every block's boxes outlined, tinted and labelled.
+
+    Colours come from a generator seeded with `seed` (the page index), so a
+    page looks the same whether it is drawn during the run or afterwards.
+    """
+    rng = np.random.RandomState(seed)
+    img_draw = image.copy()
+    draw = ImageDraw.Draw(img_draw)
+
+    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
+    draw2 = ImageDraw.Draw(overlay)
+    font = ImageFont.load_default()
+
+    for label_type, pixel_boxes in blocks:
+        color = (int(rng.randint(0, 200)), int(rng.randint(0, 200)), int(rng.randint(0, 255)))
+        color_a = color + (20, )
+        for x1, y1, x2, y2 in pixel_boxes:
+            try:
+                draw.rectangle([x1, y1, x2, y2], outline=color, width=4 if label_type == 'title' else 2)
+                draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
+
+                text_x = x1
+                text_y = max(0, y1 - 15)
+                text_bbox = draw.textbbox((0, 0), label_type, font=font)
+                text_width = text_bbox[2] - text_bbox[0]
+                text_height = text_bbox[3] - text_bbox[1]
+                draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height],
+                               fill=(255, 255, 255, 30))
+                draw.text((text_x, text_y), label_type, font=font, fill=color)
+            except Exception:
+                pass
+    img_draw.paste(overlay, (0, 0), overlay)
+    return img_draw
+
+
+def render_page(image, blocks, crop_prefix=None, draw=True, seed=0):
+    """Crop a page's figures and/or draw its layout; returns the layout JPEG or None.
+
+    Runs in a layout worker process (see `make_layout_pool`) or inline.
+    """
+    if crop_prefix is not None:
+        crop_figures(image, blocks, crop_prefix)
+    if not draw:
+        return None
+
+    result_image = draw_layout(image, blocks, seed)
+    if result_image.mode != 'RGB':
+        result_image = result_image.convert('RGB')
+    buffer = io.BytesIO()
+    result_image.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue(), result_image.width, result_image.height
+
+
+def make_layout_pool(workers):
+    """Forked processes for `render_page`; create it before initializing CUDA or engine threads."""
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result()
+    return pool
+
+
+class JpegPdfWriter:
+    """Streams JPEG pages into a PDF, one image XObject per page.
+
+    Every page is written to disk as soon as it is added, so memory does not
+    grow with the page count; the page tree and cross-reference table are
+    written on close. Page size follows img2pdf's default of 96 dpi. Nothing
+    is created if no page is ever added.
+    """
+
+    def __init__(self, path, dpi=96):
+        self.path = path
+        self.dpi = dpi
+        self._file = None
+        self._offsets = {}
+        self._page_ids = []
+
+    def _start_object(self, num):
+        self._offsets[num] = self._file.tell()
+        self._file.write(f'{num} 0 obj\n'.encode())
+
+    def _write_object(self, num, body):
+        self._start_object(num)
+        self._file.write(body + b'\nendobj\n')
+
+    def add_jpeg(self, data, width, height):
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+            self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+        # objects 1 (catalog) and 2 (page tree) are written on close
+        image_id = 3 + 3 * len(self._page_ids)
+        contents_id, page_id = image_id + 1, image_id + 2
+        page_w = width * 72 / self.dpi
+        page_h = height * 72 / self.dpi
+
+        self._start_object(image_id)
+        self._file.write(
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceRGB '
+            f'/BitsPerComponent 8 /Filter /DCTDecode /Length {len(data)} >>\nstream\n'.encode())
+        self._file.write(data)
+        self._file.write(b'\nendstream\nendobj\n')
+
+        stream = f'q {page_w:.4f} 0 0 {page_h:.4f} 0 0 cm /Im0 Do Q'.encode()
+        self._write_object(contents_id, b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.4f} {page_h:.4f}] '
+            f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {contents_id} 0 R >>').encode())
+        self._page_ids.append(page_id)
+
+    def close(self):
+        if self._file is None:
+            return
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self._page_ids)
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>'.encode())
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref_offset = self._file.tell()
+        num_objects = max(self._offsets) + 1
+        self._file.write(f'xref\n0 {num_objects}\n0000000000 65535 f \n'.encode())
+        for num in range(1, num_objects):
+            self._file.write(f'{self._offsets[num]:010d} 00000 n \n'.encode())
+        self._file.write(f'trailer\n<< /Size {num_objects} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode())
+        self._file.close()
+        self._file = None
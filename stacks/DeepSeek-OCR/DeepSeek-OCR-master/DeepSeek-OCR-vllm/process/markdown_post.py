@@ -0,0 +1,152 @@
+import re
+
+REF_PATTERN = re.compile(r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)', re.DOTALL)
+IMAGE_REF = '<|ref|>image<|/ref|>'
+
+_NEWLINE_RUNS = re.compile(r'(\n+)')
+
+
+def clean_formula(text):
+    """Drop `\\quad (n)` equation tags inside display formulas (OmniDocBench-style evaluation)."""
+    formula_pattern = r'\\\[(.*?)\\\]'
+
+    def process_formula(match):
+        formula = match.group(1)
+        formula = re.sub(r'\\quad\s*\([^)]*\)', '', formula)
+        formula = formula.strip()
+        return r'\[' + formula + r'\]'
+
+    return re.sub(formula_pattern, process_formula, text)
+
+
+def _collapse_once(length):
+    # one `.replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')` on a run of `length` newlines
+    quads, rest = divmod(length, 4)
+    length = 2 * quads + rest
+    triples, rest = divmod(length, 3)
+    return 2 * triples + rest
+
+
+def collapse_newline_run(length, times):
+    """Length of a newline run after `times` collapse passes (runs of <= 2 are fixed points)."""
+    while times > 0 and length > 2:
+        length = _collapse_once(length)
+        times -= 1
+    return length
+
+
+class _Run:
+    __slots__ = ('length', 'passes')
+
+    def __init__(self, length, passes=0):
+        self.length = length
+        self.passes = passes
+
+    def advance(self, passes):
+        self.length = collapse_newline_run(self.length, passes - self.passes)
+        self.passes = passes
+        return self
+
+
+def _split_runs(text):
+    """[run, text, run, ..., run]: newline runs around newline-free text, first and last run possibly empty."""
+    parts = []
+    for i, chunk in enumerate(_NEWLINE_RUNS.split(text)):
+        if i % 2:
+            parts.append(_Run(len(chunk)))
+        elif chunk:
+            parts.append(chunk)
+    if not parts or isinstance(parts[0], str):
+        parts.insert(0, _Run(0))
+    if isinstance(parts[-1], str):
+        parts.append(_Run(0))
+    return parts
+
+
+def clean_markdown(content, image_link=None, collapse_newlines=True, replace_latex=True, drop_tags=()):
+    """Turn raw grounded model output into markdown in one pass over the page.
+
+    Produces exactly what the original per-match loop produced:
+
+        for idx, ref in enumerate(image_refs):
+            content = content.replace(ref, image_link(idx))
+        for ref in other_refs:
+            content = content.replace(ref, '')[.replace(latex)][.replace('\\n\\n\\n\\n', '\\n\\n')
+                                               .replace('\\n\\n\\n', '\\n\\n')][.replace(tag, '')]
+
+    without rescanning the page once per ref. Image refs become
+    `image_link(idx)` (numbered by first occurrence); with `image_link=None`
+    they are stripped like every other ref. The collapse step above runs
+    once per ref, so a newline run is collapsed as many times as the loop
+    would have and runs that meet when a ref is removed are merged at the
+    iteration that removes it. `drop_tags` are removed after the first
+    iteration. Nothing but image links changes when the page has no other refs.
+    """
+    image_idx = {}
+    other_idx = {}
+    num_images = num_other = 0
+
+    pieces = []
+    removal = []
+    text = []
+    pos = 0
+    for match in REF_PATTERN.finditer(content):
+        ref = match.group(0)
+        text.append(content[pos:match.start()])
+        pos = match.end()
+        if image_link is not None and IMAGE_REF in ref:
+            text.append(image_link(image_idx.setdefault(ref, num_images)))
+            num_images += 1
+        else:
+            # every copy of a ref goes at the iteration of its first occurrence
+            removal.append(other_idx.setdefault(ref, num_other))
+            num_other += 1
+            pieces.append(''.join(text))
+            text = []
+    text.append(content[pos:])
+    pieces.append(''.join(text))
+
+    if not num_other:
+        return pieces[0]
+
+    if drop_tags:
+        tag_pattern = re.compile('|'.join(re.escape(tag) for tag in drop_tags))
+        split_pieces, split_removal = [], []
+        for i, piece in enumerate(pieces):
+            chunks = tag_pattern.split(piece)
+            split_pieces.extend(chunks)
+            split_removal.extend([1] * (len(chunks) - 1))
+            if i < len(removal):
+                split_removal.append(removal[i])
+        pieces, removal = split_pieces, split_removal
+
+    if not collapse_newlines:
+        result = ''.join(pieces)
+    else:
+        passes = num_other
+        pieces = [_split_runs(piece) for piece in pieces]
+        owner = list(range(len(pieces)))
+
+        def find(i):
+            while owner[i] != i:
+                owner[i] = owner[owner[i]]
+                i = owner[i]
+            return i
+
+        # removing ref k joins piece k's trailing run with piece k+1's leading
+        # run, after the `removal[k]` collapse passes that ran before it
+        for k in sorted(range(len(removal)), key=removal.__getitem__):
+            iteration = min(removal[k], passes)
+            left, right = pieces[find(k)], pieces[k + 1]
+            joined = left[-1].advance(iteration).length + right[0].advance(iteration).length
+            left[-1] = _Run(joined, iteration)
+            left.extend(right[1:])
+            owner[k + 1] = find(k)
+
+        result = ''.join(
+            part if isinstance(part, str) else '\n' * part.advance(passes).length
+            for part in pieces[0])
+
+    if replace_latex:
+        result = result.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+    return result
@@ -0,0 +1,103 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from config import MODEL_MODE, MODEL_PATH
+
+# Named like vLLM's metrics (`vllm:time_to_first_token_seconds{model_name=...}`), which the V0 engine
+# registers in the same default registry, so /metrics also serves vllm:gpu_cache_usage_perc,
+# vllm:num_requests_running/waiting, vllm:request_queue_time_seconds and the rest.
+LABELS = {"model_name": MODEL_PATH}
+
+SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 20.0, 40.0, 80.0, 160.0]
+ENCODER_SECONDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+TOKENS = [64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096, 6144, 8192]
+
+preprocess_queue_time = Histogram(
+    "deepseek_ocr:preprocess_queue_time_seconds", "Time an upload waited for a preprocessing worker.",
+    LABELS.keys(), buckets=SECONDS).labels(**LABELS)
+preprocess_time = Histogram(
+    "deepseek_ocr:preprocess_time_seconds", "Image decode or PDF page render plus tiling.",
+    LABELS.keys(), buckets=SECONDS).labels(**LABELS)
+time_to_first_token = Histogram(
+    "deepseek_ocr:time_to_first_token_seconds",
+    "Submission to the first token: engine queue, vision encoder and prefill.",
+    LABELS.keys(), buckets=SECONDS).labels(**LABELS)
+decode_time = Histogram(
+    "deepseek_ocr:request_decode_time_seconds", "First to last token of a generation.",
+    LABELS.keys(), buckets=SECONDS).labels(**LABELS)
+generation_tokens = Histogram(
+    "deepseek_ocr:request_generation_tokens", "Output tokens per generation.",
+    LABELS.keys(), buckets=TOKENS).labels(**LABELS)
+vision_tokens = Histogram(
+    "deepseek_ocr:request_vision_tokens", "Image tokens per image, by mode and number of crop tiles.",
+    [*LABELS.keys(), "mode", "tiles"], buckets=TOKENS)
+encoder_time = Histogram(
+    "deepseek_ocr:encoder_forward_time_seconds",
+    "GPU time of one vision encoder forward (SAM, CLIP and projector) over a batch of images.",
+    LABELS.keys(), buckets=ENCODER_SECONDS).labels(**LABELS)
+requests_aborted = Counter(
+    "deepseek_ocr:request_aborted_total",
+    "Generations cut short: repeat (hit max_tokens, usually a repetition loop), disconnect or deadline.",
+    [*LABELS.keys(), "reason"])
+requests_in_flight = Gauge(
+    "deepseek_ocr:num_requests_in_flight", "Generations submitted to the engine and not finished.",
+    LABELS.keys()).labels(**LABELS)
+requests_preprocessing = Gauge(
+    "deepseek_ocr:num_requests_preprocessing", "Requests holding a preprocessing admission slot.",
+    LABELS.keys()).labels(**LABELS)
+
+
+def count_abort(reason):
+    requests_aborted.labels(**LABELS, reason=reason).inc()
+
+
+def observe_image_features(features):
+    """Record the image tokens of a `tokenize_with_images` result, by its crop tile count."""
+    _, _, _, _, spatial_crop, num_image_tokens, _, _ = features[0]
+    for (width_tiles, height_tiles), tokens in zip(spatial_crop.tolist(), num_image_tokens):
+        tiles = width_tiles * height_tiles if width_tiles > 1 or height_tiles > 1 else 0
+        vision_tokens.labels(**LABELS, mode=MODEL_MODE, tiles=str(tiles)).observe(tokens)
+
+
+class GPUTimer:
+    """Observes the GPU time of a block into a histogram without synchronizing.
+
+    CUDA events are recorded around the block and read on a later call,
+    once the GPU has passed them, so the forward pass is never stalled for
+    the measurement. Falls back to wall time without CUDA.
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._pending = deque()
+
+    def _collect(self):
+        while self._pending and self._pending[0][1].query():
+            start, end = self._pending.popleft()
+            self.histogram.observe(start.elapsed_time(end) / 1000)
+
+    @contextmanager
+    def time(self):
+        if not torch.cuda.is_available():
+            start = time.perf_counter()
+            yield
+            self.histogram.observe(time.perf_counter() - start)
+            return
+        self._collect()
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        start.record()
+        yield
+        end.record()
+        self._pending.append((start, end))
+
+
+encoder_timer = GPUTimer(encoder_time)
+
+
+def render():
+    """The default registry in the text exposition format; returns (body, content type)."""
+    return generate_latest(), CONTENT_TYPE_LATEST
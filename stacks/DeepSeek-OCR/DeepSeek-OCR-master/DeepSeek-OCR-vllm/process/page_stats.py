@@ -0,0 +1,39 @@
+import numpy as np
+from PIL import Image
+
+
+def ink_ratio(image: Image.Image, step: int = 2, delta: int = 48, margin: float = 0.03) -> float:
+    """Fraction of (sub-sampled) pixels that differ from the page background.
+
+    The background level is the most common gray value, so this works for
+    white paper as well as yellowed or gray scan backs. A small border is
+    ignored to skip scanner edges and punch holes.
+    """
+    gray = np.asarray(image.convert("L"))
+    h, w = gray.shape
+    my, mx = int(h * margin), int(w * margin)
+    gray = gray[my:h - my:step, mx:w - mx:step]
+    if gray.size == 0:
+        return 0.0
+
+    background = np.bincount(gray.ravel(), minlength=256).argmax()
+    ink = np.abs(gray.astype(np.int16) - int(background)) > delta
+    return float(ink.mean())
+
+
+def is_blank_page(image: Image.Image, threshold: float) -> bool:
+    return ink_ratio(image) < threshold
+
+
+# rough calibration: a dense A4 statement page (ink ~0.12 over 6 tiles + the global view) decodes ~1.7k tokens
+TOKENS_PER_INK_VIEW = 2000
+
+
+def estimate_output_tokens(ink: float, num_views: int, max_tokens: int = 8192) -> int:
+    """Predicted decode length of a page, good enough to order pages by.
+
+    The amount of text on a page is approximated by its ink ratio times
+    the number of vision views (tiles plus global view), which grows with
+    the rendered page area in crop mode.
+    """
+    return min(max_tokens, int(ink * num_views * TOKENS_PER_INK_VIEW))
@@ -0,0 +1,201 @@
+import math
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+import numpy as np
+from PIL import Image
+
+
+def samples_to_image(width, height, stride, samples):
+    """Wrap raw RGB pixmap samples as a PIL image without any codec round trip."""
+    Image.MAX_IMAGE_PIXELS = None
+    return Image.frombuffer("RGB", (width, height), samples, "raw", "RGB", stride, 1)
+
+
+def pixmap_to_image(pixmap):
+    return samples_to_image(pixmap.width, pixmap.height, pixmap.stride, pixmap.samples)
+
+
+def pixmap_to_array(pixmap):
+    """HxWx3 uint8 array over the pixmap samples (use `torch.from_numpy` for a tensor)."""
+    rows = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)
+    return rows[:, :pixmap.width * 3].reshape(pixmap.height, pixmap.width, 3)
+
+
+def matched_zoom(page_rect, max_dpi=144, min_dpi=96):
+    """Smallest render zoom that still covers what the processor resamples the page to.
+
+    The active mode decides the target: the crop grid `count_tiles` picks
+    (IMAGE_SIZE per tile) plus the BASE_SIZE global view in crop mode, the
+    IMAGE_SIZE square for tiny/small, the BASE_SIZE pad for base/large. The
+    result is clamped to [min_dpi, max_dpi]; if the smaller render would
+    change the tile grid chosen at max_dpi, max_dpi is used.
+    """
+    from config import BASE_SIZE, IMAGE_SIZE, CROP_MODE
+    from process.image_process import count_tiles
+
+    def size_at(zoom):
+        rect = (page_rect * fitz.Matrix(zoom, zoom)).irect
+        return rect.width, rect.height
+
+    def tile_grid(width, height):
+        if not CROP_MODE or (width <= 640 and height <= 640):
+            return (1, 1)
+        return tuple(count_tiles(width, height, image_size=IMAGE_SIZE))
+
+    max_zoom = max_dpi / 72.0
+    min_zoom = min(min_dpi, max_dpi) / 72.0
+    ref_grid = tile_grid(*size_at(max_zoom))
+
+    width_pt, height_pt = page_rect.width, page_rect.height
+    if CROP_MODE:
+        need = BASE_SIZE / max(width_pt, height_pt)
+        if ref_grid != (1, 1):
+            need = max(need, IMAGE_SIZE * ref_grid[0] / width_pt, IMAGE_SIZE * ref_grid[1] / height_pt)
+    elif IMAGE_SIZE <= 640:
+        need = IMAGE_SIZE / min(width_pt, height_pt)
+    else:
+        need = BASE_SIZE / max(width_pt, height_pt)
+
+    zoom = min(max(need, min_zoom), max_zoom)
+    if tile_grid(*size_at(zoom)) != ref_grid:
+        return max_zoom
+    return zoom
+
+
+def page_matrix(page, dpi=144, min_dpi=None):
+    """Render matrix for a page: fixed `dpi`, or resolution-matched when `min_dpi` is set."""
+    zoom = dpi / 72.0 if min_dpi is None else matched_zoom(page.rect, dpi, min_dpi)
+    return fitz.Matrix(zoom, zoom)
+
+
+def render_page_image(page, dpi=144, min_dpi=None):
+    """Rasterize one fitz page to an RGB PIL image (see `page_matrix` for the resolution)."""
+    # alpha=False gives packed RGB samples, no PNG encode/decode needed
+    return pixmap_to_image(page.get_pixmap(matrix=page_matrix(page, dpi, min_dpi), alpha=False))
+
+
+def iter_pdf_images(pdf_path, dpi=144, min_dpi=None):
+    """Lazily rasterize a PDF, yielding one RGB PIL image per page."""
+    pdf_document = fitz.open(pdf_path)
+
+    try:
+        for page_num in range(pdf_document.page_count):
+            yield render_page_image(pdf_document[page_num], dpi, min_dpi)
+    finally:
+        pdf_document.close()
+
+
+def pdf_to_images_high_quality(pdf_path, dpi=144, min_dpi=None, workers=1, prefetch=16):
+    """
+    pdf2images
+    """
+    return list(open_pdf_pages(pdf_path, dpi=dpi, min_dpi=min_dpi, workers=workers, prefetch=prefetch))
+
+
+# --- multi-process rasterization ---
+# fitz documents cannot be shared across threads or processes, so every
+# worker opens its own handle (kept until the next document) and renders
+# contiguous page ranges.
+_worker_doc = None
+_worker_doc_path = None
+_worker_dpi = None
+
+
+def _init_render_worker(dpi, min_dpi):
+    global _worker_dpi
+    _worker_dpi = (dpi, min_dpi)
+
+
+def _render_range(pdf_path, start, end):
+    global _worker_doc, _worker_doc_path
+    if _worker_doc_path != pdf_path:
+        if _worker_doc is not None:
+            _worker_doc.close()
+        _worker_doc = fitz.open(pdf_path)
+        _worker_doc_path = pdf_path
+
+    pages = []
+    for page_num in range(start, end):
+        page = _worker_doc[page_num]
+        pixmap = page.get_pixmap(matrix=page_matrix(page, *_worker_dpi), alpha=False)
+        pages.append((pixmap.width, pixmap.height, pixmap.stride, pixmap.samples))
+    return pages
+
+
+def make_render_pool(workers, dpi=144, min_dpi=None):
+    """Forked rasterizer processes that can be shared by many documents.
+
+    All workers are forked on the first submit, so create (and warm) the pool
+    before initializing CUDA or starting engine threads.
+    """
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_render_worker,
+        initargs=(dpi, min_dpi),
+    )
+    pool.submit(int).result()
+    return pool
+
+
+class ParallelPdfRasterizer:
+    """Render a PDF in `workers` processes and yield the pages in order.
+
+    The document is split into ranges of `chunk_size` pages that are handed
+    out round-robin; at most `prefetch` pages (rounded up to whole chunks,
+    and at least one chunk per worker) are rendered ahead of the consumer.
+    Results are consumed in submission order, so the futures queue doubles
+    as the reorder buffer.
+
+    Without a shared `pool`, a private one is forked in the constructor, so
+    create the rasterizer before initializing CUDA or starting engine threads.
+    """
+
+    def __init__(self, pdf_path, dpi=144, min_dpi=None, workers=4, prefetch=16, chunk_size=4, pool=None):
+        with fitz.open(pdf_path) as pdf_document:
+            self.page_count = pdf_document.page_count
+
+        self._pdf_path = pdf_path
+        self._ranges = deque(
+            (start, min(start + chunk_size, self.page_count))
+            for start in range(0, self.page_count, chunk_size))
+        self._max_inflight = max(workers, math.ceil(prefetch / chunk_size))
+        self._futures = deque()
+        self._owns_pool = pool is None
+        self._pool = make_render_pool(workers, dpi, min_dpi) if pool is None else pool
+        self._fill()
+
+    def _fill(self):
+        while self._ranges and len(self._futures) < self._max_inflight:
+            self._futures.append(self._pool.submit(_render_range, self._pdf_path, *self._ranges.popleft()))
+
+    def __len__(self):
+        return self.page_count
+
+    def __iter__(self):
+        try:
+            while self._futures:
+                pages = self._futures.popleft().result()
+                self._fill()
+                for raw in pages:
+                    yield samples_to_image(*raw)
+        finally:
+            for future in self._futures:
+                future.cancel()
+            if self._owns_pool:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def open_pdf_pages(pdf_path, dpi=144, min_dpi=None, workers=1, prefetch=16, pool=None):
+    """Ordered page iterator: sequential for one worker, multi-process otherwise.
+
+    A shared `pool` from `make_render_pool` must have been created with the
+    same dpi settings.
+    """
+    if workers > 1 or pool is not None:
+        return ParallelPdfRasterizer(pdf_path, dpi=dpi, min_dpi=min_dpi, workers=workers,
+                                     prefetch=prefetch, pool=pool)
+    return iter_pdf_images(pdf_path, dpi=dpi, min_dpi=min_dpi)
@@ -0,0 +1,128 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+
+class Overloaded(Exception):
+    """Every admission slot is taken; `retry_after` is the suggested wait in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"preprocessing queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class PreprocessPool:
+    """Worker threads for image decode and tiling, with bounded admission.
+
+    A request takes a slot with `admit()` before its body is read and keeps
+    it (plus one per extra image of a batch) until its preprocessing is
+    done; when `max_pending` slots are taken the next one is refused with
+    `Overloaded` instead of queueing without bound. `run()` executes a
+    function on a worker thread so the event loop stays free for streaming
+    responses and health checks; `run_serial()` uses one dedicated thread
+    instead, for libraries such as PyMuPDF that are not thread-safe. Must
+    be used from the event loop thread. `observe(wait, run)`, if given, is
+    called with the seconds every finished job waited for a worker and ran.
+    """
+
+    def __init__(self, workers, max_pending, window=256, observe=None):
+        self.workers = workers
+        self.observe = observe
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        self._serial_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preprocess-serial")
+        self.pending = 0
+        self.running = 0
+        self._running_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        # (seconds waiting for a worker, seconds running) of the latest jobs
+        self._latencies = deque(maxlen=window)
+
+    def retry_after(self):
+        """Seconds until the queue ahead of a new request should have drained."""
+        runs = [run for _, run in self._latencies]
+        average = sum(runs) / len(runs) if runs else 1.0
+        return max(1, math.ceil(self.pending * average / self.workers))
+
+    @asynccontextmanager
+    async def admit(self, slots=1):
+        # a batch larger than the whole queue still gets in when nothing else is pending
+        if self.pending and self.pending + slots > self.max_pending:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+        self.pending += slots
+        try:
+            yield self
+        finally:
+            self.pending -= slots
+
+    async def run(self, fn, *args):
+        return await self._run(self._executor, fn, args)
+
+    async def run_serial(self, fn, *args):
+        return await self._run(self._serial_executor, fn, args)
+
+    async def _run(self, executor, fn, args):
+        submitted = time.perf_counter()
+        started = []
+
+        def job():
+            started.append(time.perf_counter())
+            with self._running_lock:
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._running_lock:
+                    self.running -= 1
+
+        cf_future = executor.submit(job)
+        future = asyncio.wrap_future(cf_future)
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not cf_future.cancel():
+                # already running on the caller's data: let it finish before the caller lets go
+                await asyncio.wait([future])
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finished = time.perf_counter()
+        self.completed += 1
+        self._latencies.append((started[0] - submitted, finished - started[0]))
+        if self.observe is not None:
+            self.observe(started[0] - submitted, finished - started[0])
+        return result
+
+    def stats(self):
+        waits = sorted(wait for wait, _ in self._latencies)
+        runs = sorted(run for _, run in self._latencies)
+
+        def quantile(values, q):
+            return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "queued": max(0, self.pending - self.running),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_p50": quantile(waits, 0.5),
+            "wait_p95": quantile(waits, 0.95),
+            "latency_p50": quantile(runs, 0.5),
+            "latency_p95": quantile(runs, 0.95),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._serial_executor.shutdown(wait=False, cancel_futures=True)
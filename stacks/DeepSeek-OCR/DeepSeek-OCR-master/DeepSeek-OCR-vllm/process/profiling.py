@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+_NULL = nullcontext()
+_active = None  # the ProfileSession capturing right now, if any
+
+
+def stage(name, sync=False):
+    """Time a stage of request handling while a profile is captured; a no-op otherwise.
+
+    With `sync=True` the GPU is synchronized at both ends (only while
+    capturing), so a GPU stage is timed rather than just its kernel launches.
+    """
+    session = _active
+    if session is None:
+        return _NULL
+    return session.stage(name, sync)
+
+
+def request_done():
+    session = _active
+    if session is not None:
+        session.request_done()
+
+
+def _synchronize():
+    if torch.cuda.is_available() and not torch.cuda.is_current_stream_capturing():
+        torch.cuda.synchronize()
+
+
+class ProfileSession:
+    """One capture: `torch.profiler` plus the `stage()` timers, for N requests or T seconds.
+
+    `run()` starts the capture, stops it after `max_requests` finished
+    generations or `max_seconds`, whichever comes first, and writes to
+    `directory`: `trace.json` (Chrome trace, open in Perfetto or
+    chrome://tracing), `summary.txt` (top operators by GPU and CPU time)
+    and `stages.json` (count, total, mean and max seconds per stage).
+    Decode steps replayed from CUDA graphs run no Python, so they show up
+    as kernels in the trace but not as `llm` stages. Start and stop happen
+    on the event loop thread (the profiler's state is per thread); only
+    writing the results happens on a worker thread.
+    """
+
+    def __init__(self, directory, max_requests=None, max_seconds=60.0):
+        self.directory = directory
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+        self.requests = 0
+        self.state = "pending"
+        self.error = None
+        self.started = self.stopped = None
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._enough = asyncio.Event()
+        self._loop = None
+        self._profiler = None
+
+    @contextmanager
+    def stage(self, name, sync):
+        if sync:
+            _synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            if sync:
+                _synchronize()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            count, total, longest = self._stages.get(name, (0, 0.0, 0.0))
+            self._stages[name] = (count + 1, total + elapsed, max(longest, elapsed))
+
+    def request_done(self):
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            self._loop.call_soon_threadsafe(self._enough.set)
+
+    def _start(self):
+        global _active
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self._profiler.start()
+        self._loop = asyncio.get_running_loop()
+        self.started = time.time()
+        self.state = "capturing"
+        _active = self
+
+    def _stop(self):
+        global _active
+        _active = None
+        self._profiler.stop()
+        self.stopped = time.time()
+        self.state = "writing"
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._profiler.export_chrome_trace(os.path.join(self.directory, "trace.json"))
+        sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        with open(os.path.join(self.directory, "summary.txt"), "w") as f:
+            f.write(self._profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        stages = {name: {"count": count, "total": total, "mean": total / count, "max": longest}
+                  for name, (count, total, longest) in sorted(self._stages.items())}
+        with open(os.path.join(self.directory, "stages.json"), "w") as f:
+            json.dump({"requests": self.requests, "seconds": self.stopped - self.started, "stages": stages},
+                      f, indent=2)
+
+    async def run(self):
+        self._start()
+        try:
+            await asyncio.wait_for(self._enough.wait(), self.max_seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._stop()
+        try:
+            # the trace of a busy minute is hundreds of MB of JSON
+            await asyncio.to_thread(self._write)
+            self.state = "done"
+        except Exception as e:
+            self.state, self.error = "failed", str(e)
+
+    def status(self):
+        return {"state": self.state, "directory": self.directory, "requests": self.requests,
+                "max_requests": self.max_requests, "max_seconds": self.max_seconds,
+                "started": self.started, "stopped": self.stopped, "error": self.error}
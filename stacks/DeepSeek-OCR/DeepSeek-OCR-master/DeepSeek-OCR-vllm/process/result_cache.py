@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, Optional
+
+
+def _text(result) -> str:
+    return result.outputs[0].text if result is not None and result.outputs else ""
+
+
+class _Generation:
+    """One engine generation shared by every request for its key.
+
+    Consumes the engine's cumulative outputs in its own task; `latest` is
+    the newest one, so a request that joins late starts from the text
+    decoded so far.
+    """
+
+    def __init__(self, results: AsyncIterator):
+        self.latest = None
+        self.version = 0
+        self.waiters = 0
+        self._changed = asyncio.get_running_loop().create_future()
+        self.task = asyncio.ensure_future(self._consume(results))
+
+    async def _consume(self, results):
+        async for result in results:
+            self.latest = result
+            self.version += 1
+            self._changed.set_result(None)
+            self._changed = asyncio.get_running_loop().create_future()
+        return self.latest
+
+    async def updates(self):
+        """Yield `latest` each time it changes, until the generation ends (raising its error, if any)."""
+        seen = 0
+        while True:
+            if self.version > seen:
+                seen = self.version
+                yield self.latest
+            elif self.task.done():
+                self.task.result()
+                return
+            else:
+                await asyncio.wait({self._changed, self.task}, return_when=asyncio.FIRST_COMPLETED)
+
+
+class OCRResultCache:
+    """Content-addressed LRU cache for OCR results.
+
+    Entries are keyed by the hash of the raw image bytes plus everything that
+    changes the output (mode, prompt, sampling params). The memory tier is
+    bounded by the UTF-8 size of the cached texts; the optional disk tier is
+    write-through so results survive restarts. Concurrent identical requests,
+    streamed or not, share one in-flight generation. Only generations that
+    end on their own (finish reason "stop") are stored: one cut short by
+    max_tokens, an abort or a deadline would be served truncated forever.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = ""):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, _Generation] = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(image_bytes: bytes, mode: str, prompt: str, sampling: dict) -> str:
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        params = json.dumps(sampling, sort_keys=True, default=str)
+        return hashlib.sha256(f"{image_hash}|{mode}|{prompt}|{params}".encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.mmd")
+
+    def _store(self, key: str, text: str):
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old.encode("utf-8"))
+        self._entries[key] = text
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.encode("utf-8"))
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[str]:
+        text = self._entries.get(key)
+        if text is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                    text = f.read()
+            except FileNotFoundError:
+                text = None
+            if text is not None:
+                self._store(key, text)
+                self.disk_hits += 1
+                return text
+
+        return None
+
+    def put(self, key: str, text: str):
+        self._store(key, text)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+
+    def _join(self, key: str, generate: Callable[[], AsyncIterator]) -> _Generation:
+        generation = self._inflight.get(key)
+        if generation is None:
+            self.misses += 1
+            generation = _Generation(generate())
+            self._inflight[key] = generation
+            generation.task.add_done_callback(lambda task, key=key: self._finished(key, task))
+        else:
+            self.shared += 1
+        generation.waiters += 1
+        return generation
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if result is not None and result.outputs and result.outputs[0].finish_reason == "stop":
+            self.put(key, _text(result))
+
+    @staticmethod
+    def _leave(generation: _Generation):
+        generation.waiters -= 1
+        if generation.waiters == 0 and not generation.task.done():
+            generation.task.cancel()
+
+    async def get_or_compute(self, key: str, generate: Callable[[], AsyncIterator]) -> str:
+        """Return the cached text for `key`, or the final text of one generation
+        shared by all concurrent callers asking for the same key.
+
+        `generate()` returns the engine's async iterator of cumulative
+        outputs. The generation runs as its own task; it is cancelled only
+        when every caller waiting on it has gone away.
+        """
+        text = self.get(key)
+        if text is not None:
+            return text
+
+        generation = self._join(key, generate)
+        try:
+            return _text(await asyncio.shield(generation.task))
+        finally:
+            self._leave(generation)
+
+    async def stream(self, key: str, generate: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """Yield the cumulative outputs of the generation for `key` as they are decoded.
+
+        The streaming counterpart of `get_or_compute`, for a caller that has
+        already missed `get`: it shares the generation with every other
+        request for the key, and a late joiner first gets the output so far.
+        """
+        generation = self._join(key, generate)
+        try:
+            async for result in generation.updates():
+                yield result
+        finally:
+            self._leave(generation)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "shared_inflight": self.shared,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,154 @@
+import statistics
+
+import fitz
+
+
+def _clip_area(bbox, page_rect):
+    rect = fitz.Rect(bbox) & page_rect
+    return 0.0 if rect.is_empty else rect.width * rect.height
+
+
+def _block_text(block):
+    lines = []
+    for line in block["lines"]:
+        text = "".join(span["text"] for span in line["spans"]).strip()
+        if text:
+            lines.append(text)
+
+    text = ""
+    for line in lines:
+        if text.endswith("-") and line[:1].islower():
+            text = text[:-1] + line
+        else:
+            text = f"{text} {line}" if text else line
+    return text
+
+
+def _reading_order(text_blocks, image_blocks):
+    """Merge image blocks into PyMuPDF's text block order.
+
+    PyMuPDF already orders text blocks column by column; sorting them by y
+    would interleave the columns of a multi-column page. Each image goes
+    before the first text block of its column (horizontal overlap) that
+    starts below the image's top edge, or last if there is none.
+    """
+    blocks = list(text_blocks)
+    for image in sorted(image_blocks, key=lambda b: (b["bbox"][1], b["bbox"][0])):
+        x0, y0, x1, _ = image["bbox"]
+        position = next((i for i, block in enumerate(blocks)
+                         if block["type"] == 0 and block["bbox"][1] >= y0
+                         and block["bbox"][0] < x1 and block["bbox"][2] > x0), len(blocks))
+        blocks.insert(position, image)
+    return blocks
+
+
+def page_text_stats(page):
+    """Character, garbage and coverage statistics of a page's embedded text layer."""
+    page_rect = page.rect
+    page_area = max(page_rect.width * page_rect.height, 1.0)
+    # image blocks come from get_image_info so the dict skips image payloads
+    flags = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+    blocks = _reading_order([b for b in page.get_text("dict", flags=flags)["blocks"] if b["type"] == 0],
+                            [{"type": 1, "bbox": info["bbox"]} for info in page.get_image_info()])
+
+    num_chars = 0
+    num_bad = 0
+    text_area = 0.0
+    image_area = 0.0
+    for block in blocks:
+        if block["type"] == 1:
+            image_area += _clip_area(block["bbox"], page_rect)
+            continue
+        text_area += _clip_area(block["bbox"], page_rect)
+        for line in block["lines"]:
+            for span in line["spans"]:
+                for ch in span["text"]:
+                    num_chars += 1
+                    if ch == "\ufffd" or (ord(ch) < 32 and ch not in "\t\n"):
+                        num_bad += 1
+
+    return {
+        "blocks": blocks,
+        "chars": num_chars,
+        "bad_ratio": num_bad / max(num_chars, 1),
+        "text_coverage": text_area / page_area,
+        "image_coverage": image_area / page_area,
+    }
+
+
+def is_text_layer_trustworthy(page, stats, min_chars=200, max_bad_ratio=0.01, max_image_coverage=0.5):
+    """True for born-digital pages whose text layer can replace OCR.
+
+    Scans (a large page image, possibly with an invisible OCR layer), pages
+    with broken font encodings and pages with tables, which the model
+    renders as HTML, stay on the OCR path.
+    """
+    if stats["chars"] < min_chars or stats["bad_ratio"] > max_bad_ratio:
+        return False
+    if stats["image_coverage"] > max_image_coverage:
+        return False
+    if hasattr(page, "find_tables") and page.find_tables().tables:
+        return False
+    return True
+
+
+def page_to_markdown(page, blocks, grounding=True):
+    """Markdown for a page from its text layer, in the model's output grammar.
+
+    With `grounding`, every block is prefixed with a
+    `<|ref|>label<|/ref|><|det|>[[x1, y1, x2, y2]]<|/det|>` span on the
+    0-999 grid, so figure cropping, layout drawing and post-processing treat
+    the page exactly like model output. Image blocks become `image` refs.
+    """
+    width, height = page.rect.width, page.rect.height
+
+    sizes = []
+    for block in blocks:
+        if block["type"] == 0:
+            for line in block["lines"]:
+                for span in line["spans"]:
+                    sizes.extend([span["size"]] * len(span["text"].strip()))
+    body_size = statistics.median(sizes) if sizes else 0.0
+
+    parts = []
+    for block in blocks:
+        x1, y1, x2, y2 = block["bbox"]
+        box = [max(0, min(999, int(round(v)))) for v in
+               (x1 / width * 999, y1 / height * 999, x2 / width * 999, y2 / height * 999)]
+        det = f'<|det|>[[{box[0]}, {box[1]}, {box[2]}, {box[3]}]]<|/det|>'
+
+        if block["type"] == 1:
+            if grounding:
+                parts.append(f'<|ref|>image<|/ref|>{det}\n')
+            continue
+
+        text = _block_text(block)
+        if not text:
+            continue
+
+        size = max(span["size"] for line in block["lines"] for span in line["spans"])
+        if body_size and size >= 1.6 * body_size and len(text) < 200:
+            label, text = 'title', f'# {text}'
+        elif body_size and size >= 1.2 * body_size and len(text) < 200:
+            label, text = 'sub_title', f'## {text}'
+        else:
+            label = 'text'
+
+        if grounding:
+            parts.append(f'<|ref|>{label}<|/ref|>{det}\n{text}\n\n')
+        else:
+            parts.append(f'{text}\n\n')
+
+    return ''.join(parts)
+
+
+def iter_text_layer_pages(pdf_path, grounding=True, min_chars=200, max_image_coverage=0.5):
+    """Yield markdown for pages served from the text layer, None for pages that need OCR."""
+    with fitz.open(pdf_path) as pdf_document:
+        for page in pdf_document:
+            stats = page_text_stats(page)
+            if is_text_layer_trustworthy(page, stats, min_chars=min_chars,
+                                         max_image_coverage=max_image_coverage):
+                yield page_to_markdown(page, stats["blocks"], grounding=grounding)
+            else:
+                yield None
@@ -0,0 +1,240 @@
+import io
+import threading
+from contextlib import contextmanager
+
+from PIL import Image, ImageOps
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    try:
+        from multipart.multipart import MultipartParser, parse_options_header
+    except ImportError:
+        MultipartParser = parse_options_header = None
+
+
+class UploadError(Exception):
+    """A request body that cannot be used; carries the HTTP status to answer with."""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadBuffer:
+    """Growable byte buffer that keeps its capacity between requests.
+
+    Data is written in place, so filling a buffer that has held a scan of the
+    same size before allocates nothing; `view()` exposes the filled part
+    without copying.
+    """
+
+    def __init__(self, capacity=0):
+        self._data = bytearray(capacity)
+        self.length = 0
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def clear(self):
+        self.length = 0
+
+    def write(self, chunk):
+        end = self.length + len(chunk)
+        if end > len(self._data):
+            # grow geometrically; the new tail is overwritten right away
+            self._data.extend(bytes(max(end, 2 * len(self._data)) - len(self._data)))
+        self._data[self.length:end] = chunk
+        self.length = end
+
+    def view(self):
+        return memoryview(self._data)[:self.length]
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only file over a memoryview, so PIL reads the upload in place."""
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        chunk = self._view[self._pos:self._pos + len(target)]
+        target[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class BufferPool:
+    """Free list of `UploadBuffer`s shared by concurrent requests.
+
+    A request borrows a buffer for as long as it needs the raw bytes. Up to
+    `max_idle` buffers are kept once returned, each at most `max_retained`
+    bytes, so steady traffic of similar scans stops allocating.
+    """
+
+    def __init__(self, max_idle=8, initial_bytes=8 << 20, max_retained=32 << 20):
+        self.max_idle = max_idle
+        self.initial_bytes = initial_bytes
+        self.max_retained = max_retained
+        self._idle = []
+        self._lock = threading.Lock()
+        self.allocations = 0
+
+    @contextmanager
+    def borrow(self):
+        with self._lock:
+            buffer = self._idle.pop() if self._idle else None
+        if buffer is None:
+            buffer = UploadBuffer(self.initial_bytes)
+            self.allocations += 1
+        try:
+            yield buffer
+        finally:
+            buffer.clear()
+            with self._lock:
+                if len(self._idle) < self.max_idle and buffer.capacity <= self.max_retained:
+                    self._idle.append(buffer)
+
+    def stats(self):
+        return {"idle": len(self._idle), "allocations": self.allocations}
+
+
+async def read_body(chunks, buffer, max_bytes):
+    """Copy an async iterator of body chunks (e.g. `request.stream()`) into `buffer`."""
+    async for chunk in chunks:
+        if buffer.length + len(chunk) > max_bytes:
+            raise UploadError(413, f"body exceeds {max_bytes} bytes")
+        buffer.write(chunk)
+
+
+async def _parse_multipart(chunks, content_type, max_bytes, open_file):
+    """Stream a multipart/form-data body part by part.
+
+    `open_file(name, has_filename)` is asked for a buffer for every part and
+    returns None for parts that are plain fields. Returns those fields as a
+    dict of strings.
+    """
+    if MultipartParser is None:
+        raise UploadError(415, "multipart uploads need the python-multipart package")
+    _, params = parse_options_header(content_type)
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise UploadError(400, "multipart body without a boundary")
+
+    fields = {}
+    state = {"name": None, "file": None, "header": b"", "value": b"", "headers": {},
+             "field": bytearray(), "size": 0}
+
+    def on_part_begin():
+        state["headers"] = {}
+        state["field"] = bytearray()
+
+    def on_header_field(data, start, end):
+        state["header"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header"].lower()] = state["value"]
+        state["header"] = state["value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        state["name"] = options.get(b"name", b"").decode("utf-8", "replace")
+        state["file"] = open_file(state["name"], b"filename" in options)
+
+    def on_part_data(data, start, end):
+        state["size"] += end - start
+        if state["size"] > max_bytes:
+            raise UploadError(413, f"body exceeds {max_bytes} bytes")
+        if state["file"] is not None:
+            state["file"].write(memoryview(data)[start:end])
+        else:
+            state["field"] += data[start:end]
+
+    def on_part_end():
+        if state["file"] is None:
+            fields[state["name"]] = state["field"].decode("utf-8", "replace")
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    async for chunk in chunks:
+        parser.write(chunk)
+    parser.finalize()
+    return fields
+
+
+async def read_multipart(chunks, content_type, buffer, max_bytes, file_field="file"):
+    """Stream a multipart/form-data body: the image part goes into `buffer`.
+
+    The image is the part named `file_field`, or else the first part with a
+    filename. Returns the other (small) fields as a dict of strings.
+    """
+    found = []
+
+    def open_file(name, has_filename):
+        if found or not (name == file_field or has_filename):
+            return None
+        found.append(name)
+        return buffer
+
+    fields = await _parse_multipart(chunks, content_type, max_bytes, open_file)
+    if not found:
+        raise UploadError(400, f"multipart body has no '{file_field}' part")
+    return fields
+
+
+async def read_multipart_files(chunks, content_type, buffer, max_bytes, max_files):
+    """Stream a multipart/form-data body with many images into one buffer.
+
+    Every part with a filename is an image; the images are written back to
+    back into `buffer`, so a batch costs one buffer the size of its upload.
+    Returns (fields, views of the images in body order).
+    """
+    starts = []
+
+    def open_file(name, has_filename):
+        if not has_filename:
+            return None
+        if len(starts) == max_files:
+            raise UploadError(413, f"more than {max_files} images")
+        # fields between images are not written to the buffer, so an image ends where the next starts
+        starts.append(buffer.length)
+        return buffer
+
+    fields = await _parse_multipart(chunks, content_type, max_bytes, open_file)
+    view = buffer.view()
+    return fields, [view[start:end] for start, end in zip(starts, starts[1:] + [buffer.length])]
+
+
+def decode_image_buffer(view) -> Image.Image:
+    """Decode an image straight from a buffer view, honouring EXIF orientation."""
+    image = Image.open(BufferReader(view))
+    return ImageOps.exif_transpose(image).convert("RGB")
@@ -0,0 +1,96 @@
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+from PIL import Image
+
+
+def image_digest(image: Image.Image) -> torch.Tensor:
+    """128-bit content hash of a PIL image as a LongTensor of shape [2]."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode("ascii"))
+    h.update(image.tobytes())
+    return torch.frombuffer(bytearray(h.digest()), dtype=torch.int64).clone()
+
+
+def _nbytes(t: torch.Tensor) -> int:
+    return t.numel() * t.element_size()
+
+
+class VisionEmbeddingCache:
+    """Two-tier LRU cache of projected vision embeddings.
+
+    Entries live on the GPU up to `gpu_bytes`; the least recently used ones
+    spill to host memory (up to `cpu_bytes`) and are promoted back on a hit.
+    """
+
+    def __init__(self, gpu_bytes: int, cpu_bytes: int):
+        self.gpu_bytes = gpu_bytes
+        self.cpu_bytes = cpu_bytes
+        self._gpu: "OrderedDict[Tuple, torch.Tensor]" = OrderedDict()
+        self._cpu: "OrderedDict[Tuple, torch.Tensor]" = OrderedDict()
+        self._gpu_used = 0
+        self._cpu_used = 0
+
+        self.hits = 0
+        self.cpu_hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple, device: torch.device) -> Optional[torch.Tensor]:
+        emb = self._gpu.get(key)
+        if emb is not None:
+            self._gpu.move_to_end(key)
+            self.hits += 1
+            return emb
+
+        emb = self._cpu.get(key)
+        if emb is not None:
+            self.cpu_hits += 1
+            if self.gpu_bytes == 0:
+                # host-only cache: the entry stays where it is
+                self._cpu.move_to_end(key)
+                return emb.to(device, non_blocking=True)
+            del self._cpu[key]
+            self._cpu_used -= _nbytes(emb)
+            emb = emb.to(device, non_blocking=True)
+            self._insert_gpu(key, emb)
+            return emb
+
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple, emb: torch.Tensor):
+        emb = emb.detach()
+        if _nbytes(emb) <= self.gpu_bytes:
+            self._insert_gpu(key, emb)
+        else:
+            self._insert_cpu(key, emb.to("cpu"))
+
+    def _insert_gpu(self, key: Tuple, emb: torch.Tensor):
+        self._gpu[key] = emb
+        self._gpu_used += _nbytes(emb)
+        while self._gpu_used > self.gpu_bytes and self._gpu:
+            old_key, old = self._gpu.popitem(last=False)
+            self._gpu_used -= _nbytes(old)
+            self._insert_cpu(old_key, old.to("cpu"))
+
+    def _insert_cpu(self, key: Tuple, emb: torch.Tensor):
+        if _nbytes(emb) > self.cpu_bytes:
+            return
+        self._cpu[key] = emb
+        self._cpu_used += _nbytes(emb)
+        while self._cpu_used > self.cpu_bytes:
+            _, old = self._cpu.popitem(last=False)
+            self._cpu_used -= _nbytes(old)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "cpu_hits": self.cpu_hits,
+            "misses": self.misses,
+            "gpu_entries": len(self._gpu),
+            "gpu_bytes": self._gpu_used,
+            "cpu_entries": len(self._cpu),
+            "cpu_bytes": self._cpu_used,
+        }
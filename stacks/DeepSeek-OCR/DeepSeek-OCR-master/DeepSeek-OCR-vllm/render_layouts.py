@@ -0,0 +1,57 @@
+"""Draw `_layouts.pdf` after the fact from a PDF run's `_layout.jsonl`.
+
+For runs with LAYOUT_MODE=deferred: pages are re-rasterized at the size
+recorded in the layout file, annotated in worker processes and streamed
+into the output PDF in page order. Needs neither the GPU nor the model.
+
+    python render_layouts.py input.pdf output/input_layout.jsonl [-o output/input_layouts.pdf] [-w 4]
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from process.layout import read_layout
+from process.layout_render import JpegPdfWriter, render_page
+from process.pdf_render import pixmap_to_image
+
+
+def render_record(pdf_path, record):
+    with fitz.open(pdf_path) as pdf_document:
+        page = pdf_document[record['page']]
+        zoom_x = record['width'] / page.rect.width
+        zoom_y = record['height'] / page.rect.height
+        image = pixmap_to_image(page.get_pixmap(matrix=fitz.Matrix(zoom_x, zoom_y), alpha=False))
+
+    blocks = [(block['label'], block['pixel_boxes']) for block in record['blocks']]
+    return render_page(image, blocks, seed=record['page'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('pdf')
+    parser.add_argument('layout')
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    output = args.output or args.layout.replace('_layout.jsonl', '_layouts.pdf')
+    records = read_layout(args.layout)
+
+    # a bounded in-order window keeps memory flat however long the document is
+    writer = JpegPdfWriter(output)
+    futures = deque()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for record in records:
+            futures.append(pool.submit(render_record, args.pdf, record))
+            if len(futures) > 2 * args.workers:
+                writer.add_jpeg(*futures.popleft().result())
+        while futures:
+            writer.add_jpeg(*futures.popleft().result())
+    writer.close()
+    print(f'{len(records)} pages -> {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,4 @@
 import os
-import re
 from tqdm import tqdm
 import torch
 if torch.version.cuda == '11.8':
@@ -7,7 +6,7 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS, SCHEDULE_BY_LENGTH
 from concurrent.futures import ThreadPoolExecutor
 import glob
 from PIL import Image
@@ -17,7 +16,9 @@ from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import DeepseekOCRProcessor, count_views
+from process.markdown_post import clean_formula, clean_markdown
+from process.page_stats import estimate_output_tokens, ink_ratio
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
@@ -50,34 +51,6 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
-def clean_formula(text):
-
-    formula_pattern = r'\\\[(.*?)\\\]'
-    
-    def process_formula(match):
-        formula = match.group(1)
-
-        formula = re.sub(r'\\quad\s*\([^)]*\)', '', formula)
-        
-        formula = formula.strip()
-        
-        return r'\[' + formula + r'\]'
-
-    cleaned_text = re.sub(formula_pattern, process_formula, text)
-    
-    return cleaned_text
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    # mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        mathes_other.append(a_match[0])
-    return matches, mathes_other
-
 def process_single_image(image):
     """single image"""
     prompt_in = prompt
@@ -130,12 +103,19 @@ if __name__ == "__main__":
         ))
 
 
-    
+    # longest predicted pages first, so the batch does not end with a few long pages decoding alone
+    order = list(range(len(batch_inputs)))
+    if SCHEDULE_BY_LENGTH:
+        predicted = [estimate_output_tokens(ink_ratio(image), count_views(*image.size)) for image in images]
+        order.sort(key=lambda i: -predicted[i])
 
-    outputs_list = llm.generate(
-        batch_inputs,
+    generated = llm.generate(
+        [batch_inputs[i] for i in order],
         sampling_params=sampling_params
     )
+    outputs_list = [None] * len(order)
+    for i, output in zip(order, generated):
+        outputs_list[i] = output
 
 
     output_path = OUTPUT_PATH
@@ -151,9 +131,7 @@ if __name__ == "__main__":
             afile.write(content)
 
         content = clean_formula(content)
-        matches_ref, mathes_other = re_match(content)
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
+        content = clean_markdown(content, replace_latex=False, drop_tags=('<center>', '</center>'))
         
         mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
 
@@ -1,6 +1,11 @@
 import asyncio
+import argparse
+import ast
+import json
 import re
 import os
+import socket
+import uuid
 
 import torch
 if torch.version.cuda == '11.8':
@@ -16,10 +21,11 @@ import time
 from deepseek_ocr import DeepseekOCRForCausalLM
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
-from tqdm import tqdm
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
+from process.layout import parse_det
+from process.markdown_post import clean_markdown
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, OCR_SOCKET
 
 
 
@@ -60,17 +66,16 @@ def re_match(text):
 def extract_coordinates_and_label(ref_text, image_width, image_height):
 
 
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
+    label_type = ref_text[1]
+    cor_list = parse_det(ref_text[2])
+    if cor_list is None:
+        print(f'malformed det payload: {ref_text[2]!r}')
         return None
 
     return (label_type, cor_list)
 
 
-def draw_bounding_boxes(image, refs):
+def draw_bounding_boxes(image, refs, output_path=OUTPUT_PATH):
 
     image_width, image_height = image.size
     img_draw = image.copy()
@@ -105,7 +110,7 @@ def draw_bounding_boxes(image, refs):
                     if label_type == 'image':
                         try:
                             cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{img_idx}.jpg")
+                            cropped.save(f"{output_path}/images/{img_idx}.jpg")
                         except Exception as e:
                             print(e)
                             pass
@@ -137,42 +142,53 @@ def draw_bounding_boxes(image, refs):
     return img_draw
 
 
-def process_image_with_refs(image, ref_texts):
-    result_image = draw_bounding_boxes(image, ref_texts)
+def process_image_with_refs(image, ref_texts, output_path=OUTPUT_PATH):
+    result_image = draw_bounding_boxes(image, ref_texts, output_path)
     return result_image
 
 
 
 
-async def stream_generate(image=None, prompt=''):
+ENGINE_ARGS = dict(
+    model=MODEL_PATH,
+    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+    block_size=256,
+    max_model_len=8192,
+    enforce_eager=False,
+    trust_remote_code=True,  
+    tensor_parallel_size=1,
+    gpu_memory_utilization=0.75,
+)
 
+logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
 
-    engine_args = AsyncEngineArgs(
-        model=MODEL_PATH,
-        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-        block_size=256,
-        max_model_len=8192,
-        enforce_eager=False,
-        trust_remote_code=True,  
-        tensor_parallel_size=1,
-        gpu_memory_utilization=0.75,
-    )
-    engine = AsyncLLMEngine.from_engine_args(engine_args)
-    
-    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
-
-    sampling_params = SamplingParams(
-        temperature=0.0,
-        max_tokens=8192,
-        logits_processors=logits_processors,
-        skip_special_tokens=False,
-        # ignore_eos=False,
-        
-    )
+sampling_params = SamplingParams(
+    temperature=0.0,
+    max_tokens=8192,
+    logits_processors=logits_processors,
+    skip_special_tokens=False,
+    # ignore_eos=False,
     
-    request_id = f"request-{int(time.time())}"
+)
+
+
+def build_engine():
+    """Load the model, profile and capture CUDA graphs: the minutes-long part of a run."""
+    return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**ENGINE_ARGS))
+
+
+async def stream_generate(image=None, prompt='', engine=None, on_text=None):
+    """Generate for one request, passing each new piece of text to `on_text` (default: print it).
+
+    Without `engine` a fresh one is built for this call.
+    """
+    if engine is None:
+        engine = build_engine()
+
+    request_id = f"request-{uuid.uuid4().hex}"
 
     printed_length = 0  
+    final_output = ''
 
     if image and '<image>' in prompt:
         request = {
@@ -191,113 +207,219 @@ async def stream_generate(image=None, prompt=''):
         if request_output.outputs:
             full_text = request_output.outputs[0].text
             new_text = full_text[printed_length:]
-            print(new_text, end='', flush=True)
+            if on_text is None:
+                print(new_text, end='', flush=True)
+            else:
+                on_text(new_text)
             printed_length = len(full_text)
             final_output = full_text
-    print('\n') 
+    if on_text is None:
+        print('\n') 
 
     return final_output
 
 
+def prepare_inputs(image_path, prompt):
+    """Load and tokenize one image; returns (image, image features)."""
+    image = load_image(image_path)
+    if image is None:
+        raise FileNotFoundError(f'cannot load image {image_path}')
+    image = image.convert('RGB')
+    if '<image>' in prompt:
+        image_features = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
+    else:
+        image_features = ''
+    return image, image_features
 
 
-if __name__ == "__main__":
+def save_results(image, result_out, prompt, output_path=OUTPUT_PATH):
+    """Write result_ori.mmd, result.mmd, figure crops and result_with_boxes.jpg to `output_path`."""
+    if '<image>' not in prompt:
+        return
 
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
+    os.makedirs(f'{output_path}/images', exist_ok=True)
+    print('='*15 + 'save results:' + '='*15)
 
-    image = load_image(INPUT_PATH).convert('RGB')
+    image_draw = image.copy()
 
-    
-    if '<image>' in PROMPT:
+    outputs = result_out
 
-        image_features = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
-    else:
-        image_features = ''
+    with open(f'{output_path}/result_ori.mmd', 'w', encoding = 'utf-8') as afile:
+        afile.write(outputs)
 
-    prompt = PROMPT
+    matches_ref, matches_images, mathes_other = re_match(outputs)
+    # print(matches_ref)
+    result = process_image_with_refs(image_draw, matches_ref, output_path)
 
-    result_out = asyncio.run(stream_generate(image_features, prompt))
+    outputs = clean_markdown(outputs, image_link=lambda idx: f'![](images/{idx}.jpg)\n', collapse_newlines=False)
 
+    # if 'structural formula' in conversation[0]['content']:
+    #     outputs = '<smiles>' + outputs + '</smiles>'
+    with open(f'{output_path}/result.mmd', 'w', encoding = 'utf-8') as afile:
+        afile.write(outputs)
 
-    save_results = 1
+    geometry = None
+    if 'line_type' in outputs:
+        # model output, so parsed as a literal and never evaluated
+        try:
+            geometry = ast.literal_eval(outputs)
+        except (ValueError, SyntaxError):
+            pass
 
-    if save_results and '<image>' in prompt:
-        print('='*15 + 'save results:' + '='*15)
+    if geometry is not None:
+        import matplotlib.pyplot as plt
+        from matplotlib.patches import Circle
+        lines = geometry['Line']['line']
 
-        image_draw = image.copy()
+        line_type = geometry['Line']['line_type']
+        # print(lines)
 
-        outputs = result_out
+        endpoints = geometry['Line']['line_endpoint']
 
-        with open(f'{OUTPUT_PATH}/result_ori.mmd', 'w', encoding = 'utf-8') as afile:
-            afile.write(outputs)
+        fig, ax = plt.subplots(figsize=(3,3), dpi=200)
+        ax.set_xlim(-15, 15)
+        ax.set_ylim(-15, 15)
 
-        matches_ref, matches_images, mathes_other = re_match(outputs)
-        # print(matches_ref)
-        result = process_image_with_refs(image_draw, matches_ref)
+        for idx, line in enumerate(lines):
+            try:
+                p0 = ast.literal_eval(line.split(' -- ')[0])
+                p1 = ast.literal_eval(line.split(' -- ')[-1])
 
+                if line_type[idx] == '--':
+                    ax.plot([p0[0], p1[0]], [p0[1], p1[1]], linewidth=0.8, color='k')
+                else:
+                    ax.plot([p0[0], p1[0]], [p0[1], p1[1]], linewidth = 0.8, color = 'k')
+
+                ax.scatter(p0[0], p0[1], s=5, color = 'k')
+                ax.scatter(p1[0], p1[1], s=5, color = 'k')
+            except:
+                pass
+
+        for endpoint in endpoints:
+
+            label = endpoint.split(': ')[0]
+            (x, y) = ast.literal_eval(endpoint.split(': ')[1])
+            ax.annotate(label, (x, y), xytext=(1, 1), textcoords='offset points', 
+                        fontsize=5, fontweight='light')
+        
+        try:
+            if 'Circle' in geometry.keys():
+                circle_centers = geometry['Circle']['circle_center']
+                radius = geometry['Circle']['radius']
+
+                for center, r in zip(circle_centers, radius):
+                    center = ast.literal_eval(center.split(': ')[1])
+                    circle = Circle(center, radius=r, fill=False, edgecolor='black', linewidth=0.8)
+                    ax.add_patch(circle)
+        except:
+            pass
 
-        for idx, a_match_image in enumerate(tqdm(matches_images, desc="image")):
-            outputs = outputs.replace(a_match_image, f'![](images/' + str(idx) + '.jpg)\n')
 
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            outputs = outputs.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+        plt.savefig(f'{output_path}/geo.jpg')
+        plt.close()
 
-        # if 'structural formula' in conversation[0]['content']:
-        #     outputs = '<smiles>' + outputs + '</smiles>'
-        with open(f'{OUTPUT_PATH}/result.mmd', 'w', encoding = 'utf-8') as afile:
-            afile.write(outputs)
+    result.save(f'{output_path}/result_with_boxes.jpg')
 
-        if 'line_type' in outputs:
-            import matplotlib.pyplot as plt
-            from matplotlib.patches import Circle
-            lines = eval(outputs)['Line']['line']
 
-            line_type = eval(outputs)['Line']['line_type']
-            # print(lines)
+def resolve_output(output):
+    """A client's output directory, resolved against OUTPUT_PATH; it must stay inside OUTPUT_PATH."""
+    root = os.path.realpath(OUTPUT_PATH)
+    output_path = os.path.realpath(os.path.join(root, output))
+    if os.path.commonpath([root, output_path]) != root:
+        raise PermissionError(f'output {output} is outside {root}')
+    return output_path
 
-            endpoints = eval(outputs)['Line']['line_endpoint']
 
-            fig, ax = plt.subplots(figsize=(3,3), dpi=200)
-            ax.set_xlim(-15, 15)
-            ax.set_ylim(-15, 15)
+def remove_stale_socket(socket_path):
+    """Unlink a socket left behind by a daemon that is gone; exit if one still answers on it."""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except FileNotFoundError:
+        return
+    except ConnectionRefusedError:
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise SystemExit(f'an OCR daemon is already running on {socket_path}')
+
+
+async def serve(socket_path=OCR_SOCKET):
+    """Keep one engine warm behind a Unix socket (see ocr_client.py).
+
+    Protocol, one JSON object per line: the client sends
+    `{"image": path, "prompt": ..., "output": dir}` (prompt and output
+    optional) and gets back `{"text": ...}` deltas as tokens are decoded,
+    then `{"done": true, "output": dir, "preprocess_seconds": ..., "seconds": ...}`
+    once the results are saved, or `{"error": ...}`. Without `output`, each
+    request gets its own `<image stem>_<id>` directory in OUTPUT_PATH, so
+    concurrent clients, whose requests the engine batches, never overwrite
+    each other. The socket is only accessible to the daemon's user, and
+    outputs are confined to OUTPUT_PATH.
+    """
+    # before the model loads, so a second daemon fails fast
+    remove_stale_socket(socket_path)
+    engine = build_engine()
+    loop = asyncio.get_running_loop()
+
+    async def handle(reader, writer):
+        def send(message):
+            writer.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
 
-            for idx, line in enumerate(lines):
+        try:
+            while line := await reader.readline():
+                start = time.time()
                 try:
-                    p0 = eval(line.split(' -- ')[0])
-                    p1 = eval(line.split(' -- ')[-1])
-
-                    if line_type[idx] == '--':
-                        ax.plot([p0[0], p1[0]], [p0[1], p1[1]], linewidth=0.8, color='k')
-                    else:
-                        ax.plot([p0[0], p1[0]], [p0[1], p1[1]], linewidth = 0.8, color = 'k')
-
-                    ax.scatter(p0[0], p0[1], s=5, color = 'k')
-                    ax.scatter(p1[0], p1[1], s=5, color = 'k')
-                except:
-                    pass
-
-            for endpoint in endpoints:
-
-                label = endpoint.split(': ')[0]
-                (x, y) = eval(endpoint.split(': ')[1])
-                ax.annotate(label, (x, y), xytext=(1, 1), textcoords='offset points', 
-                            fontsize=5, fontweight='light')
-            
-            try:
-                if 'Circle' in eval(outputs).keys():
-                    circle_centers = eval(outputs)['Circle']['circle_center']
-                    radius = eval(outputs)['Circle']['radius']
-
-                    for center, r in zip(circle_centers, radius):
-                        center = eval(center.split(': ')[1])
-                        circle = Circle(center, radius=r, fill=False, edgecolor='black', linewidth=0.8)
-                        ax.add_patch(circle)
-            except:
-                pass
+                    job = json.loads(line)
+                    prompt = job.get('prompt') or PROMPT
+                    output = job.get('output') or \
+                        f"{os.path.splitext(os.path.basename(job['image']))[0]}_{uuid.uuid4().hex[:8]}"
+                    output_path = resolve_output(output)
+                    image, image_features = await loop.run_in_executor(None, prepare_inputs, job['image'], prompt)
+                    preprocess_seconds = time.time() - start
+
+                    result_out = await stream_generate(image_features, prompt, engine, on_text=lambda text: send({'text': text}))
+                    await loop.run_in_executor(None, save_results, image, result_out, prompt, output_path)
+                    send({'done': True, 'output': output_path,
+                          'preprocess_seconds': round(preprocess_seconds, 3),
+                          'seconds': round(time.time() - start, 3)})
+                except Exception as e:
+                    send({'error': f'{type(e).__name__}: {e}'})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # created owner-only: any client that can connect has the daemon read and write files as its user
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle, path=socket_path)
+    finally:
+        os.umask(umask)
+    print(f'OCR daemon ready on {socket_path}', flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', action='store_true', help='run as a daemon on OCR_SOCKET instead of a one-shot run')
+    parser.add_argument('--socket', default=OCR_SOCKET)
+    args = parser.parse_args()
+
+    if args.serve:
+        asyncio.run(serve(args.socket))
+    else:
+        os.makedirs(OUTPUT_PATH, exist_ok=True)
+        os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
+
+        prompt = PROMPT
 
+        image, image_features = prepare_inputs(INPUT_PATH, prompt)
 
-            plt.savefig(f'{OUTPUT_PATH}/geo.jpg')
-            plt.close()
+        result_out = asyncio.run(stream_generate(image_features, prompt))
 
-        result.save(f'{OUTPUT_PATH}/result_with_boxes.jpg')
+        save_results(image, result_out, prompt)
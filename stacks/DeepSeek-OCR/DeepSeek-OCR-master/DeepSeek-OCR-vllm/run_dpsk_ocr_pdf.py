@@ -1,8 +1,11 @@
 import os
-import fitz
-import img2pdf
-import io
-import re
+import time
+import glob
+import json
+import asyncio
+import itertools
+import functools
+from collections import deque
 from tqdm import tqdm
 import torch
 from concurrent.futures import ThreadPoolExecutor
@@ -14,22 +17,33 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, MM_PREPROCESSOR_CACHE
+from config import SKIP_BLANK_PAGES, BLANK_PAGE_THRESHOLD, STREAM_MODE, STREAM_QUEUE_DEPTH
+from config import RASTER_WORKERS, RASTER_PREFETCH, RENDER_DPI, MATCH_RENDER_DPI, MIN_RENDER_DPI
+from config import USE_TEXT_LAYER, TEXT_LAYER_MIN_CHARS, TEXT_LAYER_MAX_IMAGE_COVERAGE
+from config import JOB_JOURNAL, JOURNAL_CHUNK_PAGES, MODEL_MODE, BASE_SIZE, IMAGE_SIZE, MIN_CROPS, MAX_CROPS
+from config import LAYOUT_MODE, LAYOUT_WORKERS, SCHEDULE_BY_LENGTH
 
-from PIL import Image, ImageDraw, ImageFont
-import numpy as np
 from deepseek_ocr import DeepseekOCRForCausalLM
 
 from vllm.model_executor.models.registry import ModelRegistry
 
-from vllm import LLM, SamplingParams
+from vllm import LLM, AsyncLLMEngine, SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import DeepseekOCRProcessor, count_views
+from process.job_journal import JobJournal, job_fingerprint
+from process.layout import layout_record, parse_layout
+from process.layout_render import JpegPdfWriter, make_layout_pool, render_page
+from process.markdown_post import clean_markdown
+from process.page_stats import estimate_output_tokens, ink_ratio
+from process.pdf_render import make_render_pool, open_pdf_pages, pdf_to_images_high_quality
+from process.text_layer import iter_text_layer_pages
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
+ENGINE_KWARGS = dict(
     model=MODEL_PATH,
     hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
     block_size=256,
@@ -40,185 +54,60 @@ llm = LLM(
     max_num_seqs=MAX_CONCURRENCY,
     tensor_parallel_size=1,
     gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
+    disable_mm_preprocessor_cache=not MM_PREPROCESSOR_CACHE
 )
 
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
-
-sampling_params = SamplingParams(
+NGRAM_SETTINGS = dict(ngram_size=20, window_size=50, whitelist_token_ids=frozenset({128821, 128822})) #window for fast；whitelist_token_ids: <td>,</td>
+SAMPLING_SETTINGS = dict(
     temperature=0.0,
     max_tokens=8192,
-    logits_processors=logits_processors,
     skip_special_tokens=False,
     include_stop_str_in_output=True,
 )
 
+logits_processors = [NoRepeatNGramLogitsProcessor(**NGRAM_SETTINGS)]
 
-class Colors:
-    RED = '\033[31m'
-    GREEN = '\033[32m'
-    YELLOW = '\033[33m'
-    BLUE = '\033[34m'
-    RESET = '\033[0m' 
-
-def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
-    """
-    pdf2images
-    """
-    images = []
-    
-    pdf_document = fitz.open(pdf_path)
-    
-    zoom = dpi / 72.0
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
-
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-        
-        images.append(img)
-    
-    pdf_document.close()
-    return images
-
-def pil_to_pdf_img2pdf(pil_images, output_path):
-
-    if not pil_images:
-        return
-    
-    image_bytes_list = []
-    
-    for img in pil_images:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
-    
-    try:
-        pdf_bytes = img2pdf.convert(image_bytes_list)
-        with open(output_path, "wb") as f:
-            f.write(pdf_bytes)
-
-    except Exception as e:
-        print(f"error: {e}")
-
-
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
+sampling_params = SamplingParams(
+    **SAMPLING_SETTINGS,
+    logits_processors=logits_processors,
+)
 
+EOS_TOKEN = '<｜end▁of▁sentence｜>'
 
-def extract_coordinates_and_label(ref_text, image_width, image_height):
+RENDER_KWARGS = dict(
+    dpi=RENDER_DPI,
+    min_dpi=MIN_RENDER_DPI if MATCH_RENDER_DPI else None,
+    workers=RASTER_WORKERS,
+    prefetch=RASTER_PREFETCH,
+)
 
+TEXT_LAYER_KWARGS = dict(
+    grounding='<|grounding|>' in PROMPT,
+    min_chars=TEXT_LAYER_MIN_CHARS,
+    max_image_coverage=TEXT_LAYER_MAX_IMAGE_COVERAGE,
+)
 
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
-
-
-def draw_bounding_boxes(image, refs, jdx):
-
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
-
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-    
-    #     except IOError:
-    font = ImageFont.load_default()
-
-    img_idx = 0
-    
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
-                
-                color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-
-                color_a = color + (20, )
-                for points in points_list:
-                    x1, y1, x2, y2 = points
-
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
-                    try:
-                        if label_type == 'title':
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                        else:
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-
-                        text_x = x1
-                        text_y = max(0, y1 - 15)
-                            
-                        text_bbox = draw.textbbox((0, 0), label_type, font=font)
-                        text_width = text_bbox[2] - text_bbox[0]
-                        text_height = text_bbox[3] - text_bbox[1]
-                        draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height], 
-                                    fill=(255, 255, 255, 30))
-                        
-                        draw.text((text_x, text_y), label_type, font=font, fill=color)
-                    except:
-                        pass
-        except:
-            continue
-    img_draw.paste(overlay, (0, 0), overlay)
-    return img_draw
+# everything that changes a page's raw output; a journal written under other settings is discarded
+JOURNAL_SETTINGS = dict(
+    model=MODEL_PATH,
+    prompt=PROMPT,
+    mode=(MODEL_MODE, BASE_SIZE, IMAGE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS),
+    render=(RENDER_KWARGS['dpi'], RENDER_KWARGS['min_dpi']),
+    blank=BLANK_PAGE_THRESHOLD if SKIP_BLANK_PAGES else None,
+    text_layer=TEXT_LAYER_KWARGS if USE_TEXT_LAYER else None,
+    sampling=SAMPLING_SETTINGS,
+    ngram={**NGRAM_SETTINGS, 'whitelist_token_ids': sorted(NGRAM_SETTINGS['whitelist_token_ids'])},
+)
 
+prompt = PROMPT
 
-def process_image_with_refs(image, ref_texts, jdx):
-    result_image = draw_bounding_boxes(image, ref_texts, jdx)
-    return result_image
 
+class Colors:
+    RED = '\033[31m'
+    GREEN = '\033[32m'
+    YELLOW = '\033[33m'
+    BLUE = '\033[34m'
+    RESET = '\033[0m' 
 
 def process_single_image(image):
     """single image"""
@@ -230,101 +119,496 @@ def process_single_image(image):
     return cache_item
 
 
-if __name__ == "__main__":
-
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
-    
-    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
-
-
-    images = pdf_to_images_high_quality(INPUT_PATH)
-
+def prepare_page(image):
+    """Engine request for one page (None when the page is blank) and its predicted output length."""
+    if not (SKIP_BLANK_PAGES or SCHEDULE_BY_LENGTH):
+        return process_single_image(image), 0
+    ink = ink_ratio(image)
+    if SKIP_BLANK_PAGES and ink < BLANK_PAGE_THRESHOLD:
+        return None, 0
+    return process_single_image(image), estimate_output_tokens(ink, count_views(*image.size))
 
-    prompt = PROMPT
 
-    # batch_inputs = []
-
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+class DocumentWriter:
+    """Writes a document's `.mmd`/`_det.mmd`/`_layout.jsonl` pages in page order as they complete.
 
+    Pages may be added out of order; they are held in a reorder buffer until
+    every earlier page has been written. Figure crops and, with LAYOUT_MODE
+    'on', the annotated layout page are rendered in `layout_pool` (inline
+    without one) and layout pages are streamed into `_layouts.pdf` in order.
 
-    # for image in tqdm(images):
-
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
-
-
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
+    With `journal`, every page result is also recorded in `_journal.jsonl`
+    as it arrives; a rerun replays the recorded pages through the same write
+    path, so the assembled output matches an uninterrupted run.
+    """
 
+    def __init__(self, input_path, output_path, journal=JOB_JOURNAL, layout_pool=None):
+        os.makedirs(f'{output_path}/images', exist_ok=True)
+        self.input_path = input_path
+        self.output_path = output_path
+        name = input_path.split('/')[-1]
+        self.mmd_det_path = output_path + '/' + name.replace('.pdf', '_det.mmd')
+        self.mmd_path = output_path + '/' + name.replace('pdf', 'mmd')
+        self.pdf_out_path = output_path + '/' + name.replace('.pdf', '_layouts.pdf')
+        self.report_path = output_path + '/' + name.replace('.pdf', '_report.json')
+        self.layout_path = output_path + '/' + name.replace('.pdf', '_layout.jsonl')
+        self.journal = JobJournal(output_path + '/' + name.replace('.pdf', '_journal.jsonl'),
+                                  job_fingerprint(input_path, JOURNAL_SETTINGS)) if journal else None
+
+        self.det_file = open(self.mmd_det_path, 'w', encoding='utf-8')
+        self.mmd_file = open(self.mmd_path, 'w', encoding='utf-8')
+        self.layout_file = open(self.layout_path, 'w', encoding='utf-8')
+        self.det_chars = 0
+        self.layout_pdf = JpegPdfWriter(self.pdf_out_path) if LAYOUT_MODE == 'on' else None
+        self.layout_pool = layout_pool
+        self.layout_futures = deque()
+        self.pending = {}
+        self.next_page = 0
+        self.jdx = 0
+        # where each page's content came from, and when the document had requests in the engine
+        self.sources = {'ocr': 0, 'text_layer': 0, 'blank': 0, 'error': 0}
+        self.resumed = 0
+        self.engine_intervals = []
+        self.num_pages = None
+        self.closed = False
+        self.start_time = time.time()
+        self.end_time = None
+
+    def add(self, page_idx, image, content, finished=True):
+        """Queue a page result; returns the number of pages written by this call."""
+        self.pending[page_idx] = (image, content, finished)
+        written = 0
+        while self.next_page in self.pending:
+            self._write_page(self.next_page, *self.pending.pop(self.next_page))
+            self.next_page += 1
+            written += 1
+        if written and self.next_page == self.num_pages:
+            self.close()
+        return written
+
+    def finish(self, num_pages):
+        """Declare the page count; the writer closes itself once every page is written."""
+        self.num_pages = num_pages
+        if self.next_page == num_pages:
+            self.close()
+
+    def add_output(self, page_idx, image, text):
+        """Queue raw engine output; `None` (the engine produced nothing, e.g. after an abort) is an error."""
+        if text is None:
+            return self.add_error(page_idx, image, 'the engine returned no output')
+        if EOS_TOKEN in text: # repeat no eos
+            return self._add_result(page_idx, image, 'ok', text.replace(EOS_TOKEN, ''))
+        return self._add_result(page_idx, image, 'repeat', text)
+
+    def add_blank(self, page_idx, image):
+        """Queue a blank page that was skipped before the engine."""
+        return self._add_result(page_idx, image, 'blank', '')
+
+    def add_error(self, page_idx, image, message):
+        """Queue a page OCR failed on: written empty, and left out of the journal so a rerun retries it."""
+        print(f'{Colors.RED}{self.input_path} page {page_idx}: OCR failed: {message}{Colors.RESET}')
+        return self._add_result(page_idx, image, 'error', '', record=False)
+
+    def add_text_layer(self, page_idx, image, markdown):
+        """Queue a page served from the PDF's embedded text layer."""
+        return self._add_result(page_idx, image, 'text_layer', markdown)
+
+    def replay(self, page_idx, image):
+        """Queue a page finished by an earlier run; None if the journal does not have it."""
+        record = self.journal.get(page_idx) if self.journal is not None else None
+        if record is None:
+            return None
+        self.resumed += 1
+        return self._add_result(page_idx, image, record['status'], record['det'], record=False)
+
+    def _add_result(self, page_idx, image, status, content, record=True):
+        self.sources[{'ok': 'ocr', 'repeat': 'ocr'}.get(status, status)] += 1
+        if record and self.journal is not None:
+            self.journal.record(page_idx, status, content)
+        return self.add(page_idx, image, content, finished=status != 'repeat')
+
+    def _write_page(self, page_idx, img, content, finished):
+        if not finished and SKIP_REPEAT:
+            return
 
-    output_path = OUTPUT_PATH
+        page_num = f'\n<--- Page Split --->'
 
-    os.makedirs(output_path, exist_ok=True)
+        self.det_file.write(content + f'\n{page_num}\n')
+        record = layout_record(parse_layout(content), img.width, img.height, page_idx, self.det_chars)
+        self.layout_file.write(json.dumps(record) + '\n')
+        self.det_chars += len(content) + len(page_num) + 2
+
+        blocks = [(block['label'], block['pixel_boxes']) for block in record['blocks']]
+        self._render_layout(page_idx, img, blocks)
+
+        jdx = self.jdx
+        content = clean_markdown(content, image_link=lambda idx: f'![](images/{jdx}_{idx}.jpg)\n')
+
+        self.mmd_file.write(content + f'\n{page_num}\n')
+        self.mmd_file.flush()
+        self.det_file.flush()
+        self.layout_file.flush()
+
+
+        self.jdx += 1
+
+    def _render_layout(self, page_idx, img, blocks):
+        draw = self.layout_pdf is not None
+        if not draw and not any(label == 'image' for label, _ in blocks):
+            return
+        args = (img, blocks, f'{self.output_path}/images/{self.jdx}_', draw, page_idx)
+        if self.layout_pool is None:
+            self._add_layout_page(render_page(*args))
+            return
+
+        self.layout_futures.append(self.layout_pool.submit(render_page, *args))
+        while self.layout_futures and (self.layout_futures[0].done()
+                                       or len(self.layout_futures) > 2 * LAYOUT_WORKERS):
+            self._add_layout_page(self.layout_futures.popleft().result())
+
+    def _add_layout_page(self, rendered):
+        if rendered is not None:
+            self.layout_pdf.add_jpeg(*rendered)
+
+    def close(self):
+        if self.closed:
+            return
+        assert not self.pending, f'pages never completed: {sorted(self.pending)}'
+        self.closed = True
+        self.end_time = time.time()
+        self.det_file.close()
+        self.mmd_file.close()
+        self.layout_file.close()
+        if self.journal is not None:
+            self.journal.close()
+
+        while self.layout_futures:
+            self._add_layout_page(self.layout_futures.popleft().result())
+        if self.layout_pdf is not None:
+            self.layout_pdf.close()
+        self.write_report()
+
+    def mark_engine_time(self, submitted, finished):
+        """Record that this document had requests in the engine from `submitted` to `finished`."""
+        self.engine_intervals.append((submitted, finished))
+
+    @property
+    def gpu_seconds(self):
+        """Wall time during which at least one of this document's requests was in the engine.
+
+        The same measure in both modes: the union of the llm.generate calls
+        in batch mode, of the per-page requests in stream mode.
+        """
+        total, end = 0.0, float('-inf')
+        for start, finish in sorted(self.engine_intervals):
+            if finish > end:
+                total += finish - max(start, end)
+                end = finish
+        return total
+
+    def report(self):
+        """Pages per source and the estimated engine time the non-OCR pages saved."""
+        num_ocr = self.sources['ocr']
+        per_page = self.gpu_seconds / num_ocr if num_ocr else 0.0
+        seconds = (self.end_time or time.time()) - self.start_time
+        return {
+            'input': self.input_path,
+            'pages': self.next_page,
+            'seconds': round(seconds, 2),
+            'pages_per_second': round(self.next_page / seconds, 3) if seconds > 0 else 0.0,
+            'pages_ocr': num_ocr,
+            'pages_text_layer': self.sources['text_layer'],
+            'pages_blank': self.sources['blank'],
+            'pages_failed': self.sources['error'],
+            'pages_resumed': self.resumed,
+            'gpu_seconds': round(self.gpu_seconds, 2),
+            'gpu_seconds_per_ocr_page': round(per_page, 3),
+            'gpu_seconds_saved_estimate': round(per_page * (self.sources['text_layer'] + self.sources['blank']), 2),
+        }
+
+    def write_report(self):
+        report = self.report()
+        with open(self.report_path, 'w', encoding='utf-8') as afile:
+            json.dump(report, afile, indent=2)
+        return report
+
+
+def run_batch(input_path, writer):
+    """Rasterize the whole PDF, then run all pages through `llm.generate`.
+
+    Pages already in the writer's journal are replayed instead of generated.
+    With a journal the remaining pages are generated JOURNAL_CHUNK_PAGES at a
+    time, so every finished chunk is persisted before the next one starts.
+    With SCHEDULE_BY_LENGTH the longest predicted pages are submitted first,
+    so the batch does not end with a few long pages decoding alone.
+    """
+    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
 
+    images = pdf_to_images_high_quality(input_path, **RENDER_KWARGS)
 
-    mmd_det_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_det.mmd')
-    mmd_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('pdf', 'mmd')
-    pdf_out_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layouts.pdf')
-    contents_det = ''
-    contents = ''
-    draw_images = []
-    jdx = 0
-    for output, img in zip(outputs_list, images):
-        content = output.outputs[0].text
+    if USE_TEXT_LAYER:
+        text_pages = list(iter_text_layer_pages(input_path, **TEXT_LAYER_KWARGS))
+    else:
+        text_pages = [None] * len(images)
 
-        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
-            content = content.replace('<｜end▁of▁sentence｜>', '')
+    ocr_pages = []
+    for page_idx, img in enumerate(images):
+        if writer.replay(page_idx, img) is not None:
+            continue
+        if text_pages[page_idx] is not None:
+            writer.add_text_layer(page_idx, img, text_pages[page_idx])
         else:
-            if SKIP_REPEAT:
-                continue
+            ocr_pages.append(page_idx)
 
-        
-        page_num = f'\n<--- Page Split --->'
-
-        contents_det += content + f'\n{page_num}\n'
+    # batch_inputs = []
 
-        image_draw = img.copy()
+    # blank pages keep their slot in the output but never reach the engine
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
+        prepared = list(tqdm(
+            executor.map(prepare_page, [images[page_idx] for page_idx in ocr_pages]),
+            total=len(ocr_pages),
+            desc="Pre-processed images"
+        ))
 
-        matches_ref, matches_images, mathes_other = re_match(content)
-        # print(matches_ref)
-        result_image = process_image_with_refs(image_draw, matches_ref, jdx)
+    batch_inputs = []
+    for page_idx, (item, predicted) in zip(ocr_pages, prepared):
+        if item is None:
+            writer.add_blank(page_idx, images[page_idx])
+        else:
+            batch_inputs.append((page_idx, item, predicted))
 
+    if not batch_inputs:
+        return
 
-        draw_images.append(result_image)
+    if SCHEDULE_BY_LENGTH:
+        batch_inputs.sort(key=lambda entry: -entry[2])
 
+    llm = LLM(**ENGINE_KWARGS)
 
-        for idx, a_match_image in enumerate(matches_images):
-            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+    chunk_size = JOURNAL_CHUNK_PAGES if writer.journal is not None else len(batch_inputs)
+    for chunk_start in range(0, len(batch_inputs), chunk_size):
+        chunk = batch_inputs[chunk_start:chunk_start + chunk_size]
 
-        for idx, a_match_other in enumerate(mathes_other):
-            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+        generate_start = time.time()
+        outputs_list = llm.generate(
+            [item for _, item, _ in chunk],
+            sampling_params=sampling_params
+        )
+        writer.mark_engine_time(generate_start, time.time())
 
+        for (page_idx, _, _), output in zip(chunk, outputs_list):
+            writer.add_output(page_idx, images[page_idx], output.outputs[0].text if output.outputs else None)
 
-        contents += content + f'\n{page_num}\n'
 
+async def run_stream(documents, raster_pool=None, layout_pool=None):
+    """Rasterize pages lazily and keep one async engine fed through a bounded window.
 
-        jdx += 1
+    `documents` is a list of (input_path, output_path). Pages of all documents
+    go through the same engine: the next document starts rendering while the
+    previous one is still decoding, and each output is routed back to its
+    own DocumentWriter. At most STREAM_QUEUE_DEPTH pages are alive at any time
+    (rendered but not yet written), so host memory is bounded by the queue
+    depth rather than by the page count.
 
-    with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents_det)
+    Preprocessed pages wait in a priority queue for a free engine slot; with
+    SCHEDULE_BY_LENGTH the longest predicted page in the window goes first,
+    otherwise pages go in arrival order.
+    """
+    engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**ENGINE_KWARGS))
+
+    loop = asyncio.get_running_loop()
+    window = asyncio.Semaphore(STREAM_QUEUE_DEPTH)
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_DEPTH)
+    ready = asyncio.PriorityQueue()
+    arrival = itertools.count()
+    num_preparers = min(NUM_WORKERS, STREAM_QUEUE_DEPTH)
+    num_decoders = min(MAX_CONCURRENCY, STREAM_QUEUE_DEPTH)
+    writers = []
+
+    # fitz documents must stay on one thread
+    render_pool = ThreadPoolExecutor(max_workers=1)
+    preprocess_pool = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    # DocumentWriter draws layouts, encodes JPEGs and writes files: keep it off the loop that drives
+    # the engine, on one thread so every writer still sees its calls in order
+    write_pool = ThreadPoolExecutor(max_workers=1)
+
+    def open_document(input_path):
+        pages = iter(open_pdf_pages(input_path, pool=raster_pool, **RENDER_KWARGS))
+        text_pages = iter_text_layer_pages(input_path, **TEXT_LAYER_KWARGS) if USE_TEXT_LAYER else None
+        return pages, text_pages
+
+    def next_page(pages, text_pages):
+        image = next(pages, None)
+        text = next(text_pages, None) if text_pages is not None else None
+        return image, text
+
+    async def produce():
+        for doc_idx, (input_path, output_path) in enumerate(documents):
+            writer = await loop.run_in_executor(
+                write_pool, functools.partial(DocumentWriter, input_path, output_path, layout_pool=layout_pool))
+            writers.append(writer)
+            pages, text_pages = await loop.run_in_executor(render_pool, open_document, input_path)
+
+            page_idx = 0
+            while True:
+                await window.acquire()
+                image, text = await loop.run_in_executor(render_pool, next_page, pages, text_pages)
+                if image is None:
+                    window.release()
+                    break
+                await queue.put((doc_idx, writer, page_idx, image, text))
+                page_idx += 1
+            await loop.run_in_executor(write_pool, writer.finish, page_idx)
+
+        for _ in range(num_preparers):
+            await queue.put(None)
+
+    async def write(method, *args):
+        written = await loop.run_in_executor(write_pool, method, *args)
+        progress.update(written)
+        for _ in range(written):
+            window.release()
+
+    async def prepare():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            doc_idx, writer, page_idx, image, markdown = item
+
+            if writer.journal is not None and writer.journal.get(page_idx) is not None:
+                await write(writer.replay, page_idx, image)
+            elif markdown is not None:
+                await write(writer.add_text_layer, page_idx, image, markdown)
+            else:
+                request, predicted = await loop.run_in_executor(preprocess_pool, prepare_page, image)
+                if request is None:
+                    await write(writer.add_blank, page_idx, image)
+                else:
+                    priority = -predicted if SCHEDULE_BY_LENGTH else 0
+                    await ready.put((priority, next(arrival), (doc_idx, writer, page_idx, image, request)))
+
+    async def prepare_all():
+        await asyncio.gather(produce(), *[prepare() for _ in range(num_preparers)])
+        for _ in range(num_decoders):
+            await ready.put((float('inf'), next(arrival), None))
+
+    async def decode():
+        while True:
+            _, _, item = await ready.get()
+            if item is None:
+                return
+            doc_idx, writer, page_idx, image, request = item
+
+            text = None
+            submitted = time.time()
+            async for request_output in engine.generate(request, sampling_params, f'doc-{doc_idx}-page-{page_idx}'):
+                if request_output.outputs:
+                    text = request_output.outputs[0].text
+            writer.mark_engine_time(submitted, time.time())
+            await write(writer.add_output, page_idx, image, text)
+
+    progress = tqdm(desc="Written pages")
+    try:
+        await asyncio.gather(prepare_all(), *[decode() for _ in range(num_decoders)])
+    finally:
+        progress.close()
+        render_pool.shutdown()
+        preprocess_pool.shutdown()
+        write_pool.shutdown()
+
+    return writers
+
+
+def resolve_input_paths(input_path):
+    """PDFs named by INPUT_PATH: a file, a directory, a glob or a manifest (.txt/.lst, one path per line)."""
+    if os.path.isdir(input_path):
+        return sorted(glob.glob(os.path.join(input_path, '*.pdf')))
+    if input_path.endswith(('.txt', '.lst')):
+        with open(input_path, encoding='utf-8') as afile:
+            return [line.strip() for line in afile if line.strip() and not line.startswith('#')]
+    if glob.has_magic(input_path):
+        return sorted(glob.glob(input_path))
+    return [input_path]
+
+
+def corpus_output_dirs(input_paths, output_path):
+    """One output directory per PDF: its path relative to the inputs' common directory, minus the extension.
+
+    PDFs that share a file name in different directories get separate
+    directories; two inputs that would still share one (a path listed
+    twice, or `a.pdf` next to `a.PDF`) are refused.
+    """
+    paths = [os.path.abspath(path) for path in input_paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    outputs, seen = [], {}
+    for input_path, path in zip(input_paths, paths):
+        name = os.path.splitext(os.path.relpath(path, root))[0]
+        if name in seen:
+            raise ValueError(f'{input_path} and {seen[name]} would both be written to {name}/')
+        seen[name] = input_path
+        outputs.append(os.path.join(output_path, name))
+    return outputs
+
+
+def print_report(report):
+    line = f'{report["input"]}: {report["pages"]} pages, {report["pages_per_second"]} pages/s'
+    if SKIP_BLANK_PAGES:
+        line += f', blank skipped: {report["pages_blank"]}'
+    if report['pages_failed']:
+        line += f', failed: {report["pages_failed"]}'
+    if report['pages_resumed']:
+        line += f', resumed from journal: {report["pages_resumed"]}'
+    if USE_TEXT_LAYER:
+        line += (f', text layer: {report["pages_text_layer"]}'
+                 f' (~{report["gpu_seconds_saved_estimate"]}s engine time saved)')
+    print(f'{Colors.YELLOW}{line}{Colors.RESET}')
 
-    with open(mmd_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents)
 
+if __name__ == "__main__":
 
-    pil_to_pdf_img2pdf(draw_images, pdf_out_path)
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
 
+    start = time.time()
+    input_paths = resolve_input_paths(INPUT_PATH)
+    corpus = input_paths != [INPUT_PATH]
+    output_dirs = corpus_output_dirs(input_paths, OUTPUT_PATH) if corpus else [OUTPUT_PATH]
+
+    # fork the layout workers before the engine exists
+    layout_pool = make_layout_pool(LAYOUT_WORKERS) if LAYOUT_WORKERS > 0 else None
+
+    if corpus or STREAM_MODE:
+        # corpus mode: one output directory per document, all pages through one engine
+        documents = list(zip(input_paths, output_dirs))
+        # fork the rasterizer workers before the engine exists
+        raster_pool = make_render_pool(RASTER_WORKERS, RENDER_KWARGS['dpi'], RENDER_KWARGS['min_dpi']) \
+            if RASTER_WORKERS > 1 else None
+        writers = asyncio.run(run_stream(documents, raster_pool, layout_pool))
+        if raster_pool is not None:
+            raster_pool.shutdown()
+    else:
+        writer = DocumentWriter(INPUT_PATH, OUTPUT_PATH, layout_pool=layout_pool)
+        run_batch(INPUT_PATH, writer)
+        writer.close()
+        writers = [writer]
+
+    if layout_pool is not None:
+        layout_pool.shutdown()
+
+    elapsed = time.time() - start
+    reports = [writer.report() for writer in writers]
+    for report in reports:
+        print_report(report)
+
+    total_pages = sum(report['pages'] for report in reports)
+    if corpus:
+        with open(os.path.join(OUTPUT_PATH, 'corpus_report.json'), 'w', encoding='utf-8') as afile:
+            json.dump({
+                'documents': len(reports),
+                'pages': total_pages,
+                'seconds': round(elapsed, 2),
+                'pages_per_second': round(total_pages / elapsed, 3),
+                'per_document': reports,
+            }, afile, indent=2)
+    print(f'{Colors.GREEN}{len(reports)} document(s), {total_pages} pages in {elapsed:.1f}s '
+          f'({total_pages / elapsed:.2f} pages/s){Colors.RESET}')
@@ -0,0 +1,280 @@
+"""Sweep OCR settings over an image set with ground truth and report a Pareto table.
+
+Every grid point runs in its own subprocess, because config.py and the
+processor read their settings from the environment at import time. Grid
+keys are config.py environment variables (MODEL_MODE, MAX_CROPS,
+MAX_CONCURRENCY, ...) plus NGRAM_SIZE / NGRAM_WINDOW for the no-repeat
+logits processor. Ground truth for `images/x.jpg` is `gt/x.md` (or .mmd/.txt).
+
+Per setting: pages/s (preprocessing + generation, engine load excluded),
+vision tokens and output tokens per page, repeat-abort rate (pages that hit
+max_tokens without EOS) and mean normalized edit distance against the
+ground truth, after the same post-processing as run_dpsk_ocr_eval_batch.py.
+Results are appended to <out>/sweep.jsonl and the table goes to <out>/pareto.md.
+
+    python run_ocr_sweep.py --images bench/images --gt bench/gt --out sweep \\
+        --grid MODEL_MODE=small,base,gundam --grid MAX_CROPS=4,6 \\
+        --grid NGRAM_SIZE=20,40 --grid NGRAM_WINDOW=90 --grid MAX_CONCURRENCY=64,128
+
+`--engine stub` replaces vLLM with a CPU stand-in that answers each page
+with its ground truth: preprocessing and vision-token counts are real, the
+rest only exercises the harness (NED is 0 and no page repeats).
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+try:
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    Levenshtein = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+GT_EXTENSIONS = ('.md', '.mmd', '.txt')
+
+
+class Colors:
+    RED = '\033[31m'
+    GREEN = '\033[32m'
+    YELLOW = '\033[33m'
+    BLUE = '\033[34m'
+    RESET = '\033[0m'
+
+
+def normalized_edit_distance(prediction, reference):
+    """Levenshtein distance divided by the longer length (0 = identical, 1 = nothing in common)."""
+    if Levenshtein is not None:
+        return Levenshtein.normalized_distance(prediction, reference)
+    if not prediction and not reference:
+        return 0.0
+    if len(prediction) < len(reference):
+        prediction, reference = reference, prediction
+    previous = list(range(len(reference) + 1))
+    for i, a in enumerate(prediction, 1):
+        current = [i]
+        for j, b in enumerate(reference, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a != b)))
+        previous = current
+    return previous[-1] / len(prediction)
+
+
+def load_pairs(images_dir, gt_dir, limit=None):
+    """(image path, ground truth text) for every image that has a ground-truth file."""
+    pairs = []
+    for image_path in sorted(glob.glob(os.path.join(images_dir, '*'))):
+        if not image_path.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        for ext in GT_EXTENSIONS:
+            gt_path = os.path.join(gt_dir, stem + ext)
+            if os.path.exists(gt_path):
+                with open(gt_path, encoding='utf-8') as afile:
+                    pairs.append((image_path, afile.read()))
+                break
+    return pairs[:limit] if limit else pairs
+
+
+def pareto_front(results):
+    """Indices of results no other result beats on both pages/s (higher) and NED (lower)."""
+    front = []
+    for i, a in enumerate(results):
+        dominated = any(
+            b['pages_per_second'] >= a['pages_per_second'] and b['ned'] <= a['ned']
+            and (b['pages_per_second'] > a['pages_per_second'] or b['ned'] < a['ned'])
+            for j, b in enumerate(results) if j != i)
+        if not dominated:
+            front.append(i)
+    return front
+
+
+def format_table(results, keys):
+    front = set(pareto_front(results))
+    header = ['pareto'] + keys + ['pages/s', 'vision tok/page', 'output tok/page', 'repeat abort', 'NED']
+    lines = ['| ' + ' | '.join(header) + ' |', '|' + '---|' * len(header)]
+    order = sorted(range(len(results)), key=lambda i: -results[i]['pages_per_second'])
+    for i in order:
+        result = results[i]
+        row = ['*' if i in front else ''] + [str(result['settings'].get(key, '')) for key in keys] + [
+            f"{result['pages_per_second']:.2f}",
+            f"{result['vision_tokens']:.0f}",
+            f"{result['output_tokens']:.0f}",
+            f"{result['repeat_abort_rate']:.1%}",
+            f"{result['ned']:.4f}",
+        ]
+        lines.append('| ' + ' | '.join(row) + ' |')
+    return '\n'.join(lines)
+
+
+class StubEngine:
+    """CPU stand-in for `vllm.LLM`: answers every request with its page's ground truth."""
+
+    def __init__(self, references, tokenizer):
+        self.references = references
+        self.tokenizer = tokenizer
+
+    def generate(self, batch_inputs, sampling_params=None):
+        outputs = []
+        for reference in self.references[:len(batch_inputs)]:
+            token_ids = self.tokenizer.encode(reference, add_special_tokens=False)
+            outputs.append(SimpleNamespace(outputs=[
+                SimpleNamespace(text=reference, token_ids=token_ids, finish_reason='stop')]))
+        return outputs
+
+
+def run_setting(images_dir, gt_dir, engine_name, limit=None):
+    """Evaluate the settings in this process's environment; returns the metrics dict."""
+    if engine_name == 'vllm':
+        import torch
+        if torch.version.cuda == '11.8':
+            os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+        os.environ['VLLM_USE_V1'] = '0'
+
+    from PIL import Image
+    from config import MODEL_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS, TOKENIZER
+    from process.image_process import DeepseekOCRProcessor
+    from process.markdown_post import clean_formula, clean_markdown
+
+    pairs = load_pairs(images_dir, gt_dir, limit)
+    if not pairs:
+        raise SystemExit(f'no images with ground truth under {images_dir}')
+    references = [reference for _, reference in pairs]
+
+    if engine_name == 'vllm':
+        from deepseek_ocr import DeepseekOCRForCausalLM
+        from vllm import LLM, SamplingParams
+        from vllm.model_executor.models.registry import ModelRegistry
+        from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+        ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+
+        engine = LLM(
+            model=MODEL_PATH,
+            hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+            block_size=256,
+            enforce_eager=False,
+            trust_remote_code=True,
+            max_model_len=8192,
+            swap_space=0,
+            max_num_seqs=MAX_CONCURRENCY,
+            tensor_parallel_size=1,
+            gpu_memory_utilization=0.9,
+        )
+        logits_processors = [NoRepeatNGramLogitsProcessor(
+            ngram_size=int(os.getenv('NGRAM_SIZE', 40)), window_size=int(os.getenv('NGRAM_WINDOW', 90)),
+            whitelist_token_ids={128821, 128822})]
+        sampling_params = SamplingParams(temperature=0.0, max_tokens=8192,
+                                         logits_processors=logits_processors, skip_special_tokens=False)
+    else:
+        engine = StubEngine(references, TOKENIZER)
+        sampling_params = None
+
+    def prepare(image_path):
+        image = Image.open(image_path).convert('RGB')
+        return DeepseekOCRProcessor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        prepared = list(executor.map(prepare, [image_path for image_path, _ in pairs]))
+    outputs = engine.generate(
+        [{"prompt": PROMPT, "multi_modal_data": {"image": item}} for item in prepared],
+        sampling_params=sampling_params)
+    seconds = time.time() - start
+
+    distances, output_tokens, repeats = [], 0, 0
+    for output, reference in zip(outputs, references):
+        completion = output.outputs[0]
+        output_tokens += len(completion.token_ids)
+        repeats += completion.finish_reason == 'length'
+        prediction = clean_markdown(clean_formula(completion.text), replace_latex=False,
+                                    drop_tags=('<center>', '</center>'))
+        distances.append(normalized_edit_distance(prediction, reference))
+
+    num_pages = len(pairs)
+    return {
+        'pages': num_pages,
+        'seconds': round(seconds, 3),
+        'pages_per_second': num_pages / seconds,
+        'vision_tokens': sum(sum(item[0][5]) for item in prepared) / num_pages,
+        'output_tokens': output_tokens / num_pages,
+        'repeat_abort_rate': repeats / num_pages,
+        'ned': sum(distances) / num_pages,
+    }
+
+
+def parse_grid(specs):
+    grid = {}
+    for spec in specs:
+        key, _, values = spec.partition('=')
+        grid[key.strip()] = [value.strip() for value in values.split(',') if value.strip()]
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', required=True)
+    parser.add_argument('--gt', default=None, help='ground-truth directory (default: --images)')
+    parser.add_argument('--grid', action='append', default=[], help='KEY=v1,v2,... (repeatable)')
+    parser.add_argument('--engine', choices=('vllm', 'stub'), default='vllm')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--out', default='sweep')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # workers run from the script directory
+    images_dir = os.path.abspath(args.images)
+    gt_dir = os.path.abspath(args.gt or args.images)
+
+    if args.worker:
+        metrics = run_setting(images_dir, gt_dir, args.engine, args.limit)
+        with open(args.result, 'w', encoding='utf-8') as afile:
+            json.dump(metrics, afile)
+        return
+
+    grid = parse_grid(args.grid)
+    keys = list(grid)
+    os.makedirs(args.out, exist_ok=True)
+    results = []
+
+    for values in itertools.product(*grid.values()):
+        settings = dict(zip(keys, values))
+        print(f'{Colors.BLUE}{settings}{Colors.RESET}')
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as afile:
+            result_path = afile.name
+
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--result', result_path,
+                   '--images', images_dir, '--gt', gt_dir, '--engine', args.engine]
+        if args.limit:
+            command += ['--limit', str(args.limit)]
+        completed = subprocess.run(command, env={**os.environ, **settings},
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        if completed.returncode != 0:
+            print(f'{Colors.RED}failed with exit code {completed.returncode}{Colors.RESET}')
+            os.remove(result_path)
+            continue
+        with open(result_path, encoding='utf-8') as afile:
+            result = {'settings': settings, **json.load(afile)}
+        os.remove(result_path)
+
+        results.append(result)
+        with open(os.path.join(args.out, 'sweep.jsonl'), 'a', encoding='utf-8') as afile:
+            afile.write(json.dumps(result) + '\n')
+        print(f"{Colors.YELLOW}{result['pages_per_second']:.2f} pages/s, NED {result['ned']:.4f}{Colors.RESET}")
+
+    if not results:
+        return
+    table = format_table(results, keys)
+    with open(os.path.join(args.out, 'pareto.md'), 'w', encoding='utf-8') as afile:
+        afile.write(table + '\n')
+    print(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,4 +13,7 @@ data:
       - job_name: 'vllm'
         static_configs:
           - targets: ['vllm-api:8000']
+      - job_name: 'deepseek-ocr'
+        static_configs:
+          - targets: ['deepseek-ocr-fastapi:80']
 EOF